@@ -0,0 +1,149 @@
+# benchmarks/fake_ec2.py (Python module) -- in-process stand-in for the EC2 API
+#
+# Hooks into a botocore session's event system so that every EC2 request made
+# by clients of that session is answered locally, after a configurable delay,
+# instead of being sent to AWS.  Instances change state after another delay,
+# like the real thing.  Every call is counted per region and operation.
+
+
+
+import collections
+import threading
+import time
+
+
+# Final state and transitional state for each action request
+TRANSITIONS = {'StartInstances':     ('StartingInstances', 16, 0),
+               'StopInstances':      ('StoppingInstances', 80, 64),
+               'TerminateInstances': ('TerminatingInstances', 48, 32)}
+
+STATE_NAMES = {0: 'pending', 16: 'running', 32: 'shutting-down', 48: 'terminated',
+               64: 'stopping', 80: 'stopped'}
+
+
+class HttpResponse(object):
+    """Just enough of a botocore HTTP response for the before-call hook."""
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+
+
+class FakeEC2(object):
+    def __init__(self, latency=0.02, transition_time=0.5):
+        """@param latency is the time taken to answer each request.
+        @param transition_time is how long instances stay in a transitional
+        state (e.g. stopping) after an action request."""
+        self.latency = latency
+        self.transition_time = transition_time
+        self.lock = threading.Lock()
+        self.states = {}        # instance ID -> state code
+        self.regions = {}       # instance ID -> region
+        self.targets = {}       # instance ID -> (final state code, time)
+        self.calls = collections.Counter()      # (region, operation) -> count
+
+
+    def clear(self):
+        """Forgets every instance."""
+        with self.lock:
+            self.states.clear()
+            self.regions.clear()
+            self.targets.clear()
+
+
+    def add_instance(self, instance_id, region, running=True):
+        self.states[instance_id] = 16 if running else 80
+        self.regions[instance_id] = region
+
+
+    def install(self, session):
+        """Answers requests from every EC2 client created by the (botocore)
+        session from now on."""
+        session.register('before-parameter-build.ec2', self.save_params)
+        session.register('before-call.ec2', self.handle)
+
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+
+    def save_params(self, params, context, **kwargs):
+        # before-call only sees the serialised request, so keep the API
+        # parameters for it
+        context['fake_ec2_params'] = dict(params)
+
+
+    def handle(self, model, context, **kwargs):
+        params = context.get('fake_ec2_params', {})
+        region = context.get('client_region')
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls[(region, model.name)] += 1
+            self.update_states()
+            return self.respond(model.name, region, params)
+
+
+    def update_states(self):
+        now = time.time()
+        for instance_id, (final, when) in list(self.targets.items()):
+            if now >= when:
+                self.states[instance_id] = final
+                del self.targets[instance_id]
+
+
+    def respond(self, operation, region, params):
+        if params.get('DryRun'):
+            return HttpResponse(412), {'Error': {'Code': 'DryRunOperation',
+                                                 'Message': "Request would have succeeded"}}
+
+        ids = params.get('InstanceIds', [])
+        missing = [i for i in ids if self.regions.get(i) != region]
+        if missing:
+            return HttpResponse(400), {'Error': {'Code': 'InvalidInstanceID.NotFound',
+                                                 'Message': "The instance IDs '%s' do not exist" % ", ".join(missing)}}
+
+        if operation == 'DescribeInstances':
+            filters = {f['Name']: f['Values'] for f in params.get('Filters', [])}
+            wanted = filters.get('instance-state-name')
+            instances = [self.describe(i, region) for i in ids
+                         if wanted is None or STATE_NAMES[self.states[i]] in wanted]
+            return HttpResponse(200), {'Reservations': [{'Instances': instances}]}
+        elif operation in TRANSITIONS:
+            response_key, final, transitional = TRANSITIONS[operation]
+            items = []
+            for i in ids:
+                previous = self.states[i]
+                self.states[i] = transitional
+                self.targets[i] = (final, time.time() + self.transition_time)
+                items.append({'InstanceId': i,
+                              'PreviousState': {'Code': previous, 'Name': STATE_NAMES[previous]},
+                              'CurrentState': {'Code': transitional, 'Name': STATE_NAMES[transitional]}})
+            return HttpResponse(200), {response_key: items}
+        elif operation == 'DescribeVpcs':
+            return HttpResponse(200), {'Vpcs': [{'VpcId': v, 'Tags': [{'Key': 'Name', 'Value': "vpc " + v}]}
+                                                for v in params.get('VpcIds', [])]}
+        elif operation == 'DescribeSubnets':
+            return HttpResponse(200), {'Subnets': [{'SubnetId': s, 'Tags': [{'Key': 'Name', 'Value': "subnet " + s}]}
+                                                   for s in params.get('SubnetIds', [])]}
+        else:
+            return HttpResponse(200), {}
+
+
+    def describe(self, instance_id, region):
+        import datetime
+
+        n = int(instance_id[2:], 16)
+        state = self.states[instance_id]
+        return {'InstanceId': instance_id,
+                'State': {'Code': state, 'Name': STATE_NAMES[state]},
+                'Placement': {'AvailabilityZone': region + "a"},
+                'ImageId': "ami-12345678",
+                'InstanceType': "t3.micro",
+                'LaunchTime': datetime.datetime(2020, 1, 1),
+                'PrivateIpAddress': "10.%d.%d.%d" % (n >> 16 & 255, n >> 8 & 255, n & 255),
+                'PublicIpAddress': None if n % 4 else "192.0.2.%d" % (n & 255),
+                'PublicDnsName': "",
+                'VpcId': "vpc-%04x" % (n % 8),
+                'SubnetId': "subnet-%04x" % (n % 32)}
@@ -7,7 +7,7 @@ from setuptools import setup, find_packages
 
 
 requirements = [## 'ansible>=2.7.5',
-                'boto3',
+                'botocore',
                ] ## ['Click>=6.0', ]
 
 setup_requirements = ['pytest-runner', 'bumpversion', 'setuptools~=40.4.3', 'wheel']
@@ -31,6 +31,7 @@ setup(
     setup_requires=setup_requirements,
     keywords="aws ec2 cli",
     packages=find_packages(".", exclude=['tests']),
+    package_data={'shepherd.aws': ['data/ec2/*/service-2.json']},
     version="2.0.6",
     zip_safe=False,
     license="GNU General Public License v3",
@@ -10,14 +10,59 @@ __version__ = '2.0.6'
   into them like ansible does.  However, it interoperates with ansible by
   using its inventory file; see http://docs.ansible.com/intro_inventory.html .
 
-Usage: shepherd [ -i <inventory> ] <host-pattern> [ start | stop | restart | kill ]
+Usage: shepherd [ -i <inventory> ] <host-pattern> [ start | stop | restart | kill | watch ]
+       shepherd [ options ] --batch=<file>
+       shepherd [ options ] [ --socket=<path> ] serve
 Options:
-  -i <inventory>, --inventory-file=<inventory>   Specify inventory host file
+  -i <inventory>, --inventory-file=<inventory>   Specify inventory host file, directory
+                                                 or script; can be given more than once
                                                  (default=/etc/ansible/hosts)
+  --no-inventory-cache                           Always have Ansible parse the inventory
+  --inventory-ttl=<seconds>                      Reuse the output of inventory scripts
+                                                 for this long (default=300)
   -y, --confirm                                  Confirm termination of instances
   -n, --dry_run                                  Tell boto not to perform the action
   -w, --poll                                     Wait until operation is complete
-  -s <seconds>, --interval=<seconds>             Activate -w and set the interval
+  -s <seconds>, --interval=<seconds>             Activate -w and set the longest
+                                                 interval between checks (or the
+                                                 interval for watch)
+  --timeout=<seconds>                            Activate -w and give up after this
+                                                 long (default=100), or stop watching
+  --parallel=<n>                                 Act on up to n regions at once
+                                                 (default=all of them)
+  --chunk-size=<n>                               Act on at most n instances per API
+                                                 request (default=100)
+  --no-ptr                                       Don't reverse-resolve public IPs
+  --ptr-ttl=<seconds>                            Cache reverse lookups on disk for
+                                                 this long (default=don't)
+  --state-ttl=<seconds>                          Show instance info that was cached less
+                                                 than this long ago (default=don't)
+  --fresh                                        Ignore the cached instance info
+  -o <format>, --format=<format>                 Output format: table, json, jsonl
+                                                 or csv (default=table)
+  --sort=<key>                                   Sort hosts across all regions by
+                                                 name, id, state or inventory
+                                                 (default=as each region returns them)
+  --engine=<engine>                              Run regions using threads or asyncio
+                                                 (default=threads)
+  --rate-limit=<rate>[,<rate>]                   Limit API requests per second, per
+                                                 account and region, for describe and
+                                                 other requests (default=20,5; 0=none)
+  --batch-size=<n>                               Act on at most n instances per region
+                                                 at a time, waiting for each wave to
+                                                 finish before starting the next
+                                                 (not for restart)
+  --batch-percent=<p>                            Like --batch-size, as a percentage of
+                                                 each region's instances
+  --pause=<seconds>                              Wait this long between waves
+  --stats                                        Show counts and times of API requests
+  --stats-file=<file>                            Write API request statistics as JSON
+                                                 to a file (or - for stdout)
+  --batch=<file>                                 Run each command line in a file (or
+                                                 - for stdin) and write a JSON result
+                                                 for each one
+  --socket=<path>                                Unix socket that serve listens on
+                                                 (default=$XDG_RUNTIME_DIR/shepherd.sock)
   -R, --running                                  Only show running instances
   -S, --stopped                                  Only show stopped instances
   -q, --quiet                                    Don't show useful messages
@@ -38,7 +83,6 @@ Options:
 #
 # TO-DO:
 #   + handle hosts not in in primary region
-#   + go(): create PerRegionCohort objects before taking action
 #   + detect invalid action names
 
 
@@ -53,6 +97,7 @@ from .utils.cmdline_controller import Controller
 from . import cmdline as global_cmdline
 from .aws import cmdline as aws_cmdline
 from . import inventory
+from . import formatting
 from . import errors
 
 
@@ -82,16 +127,92 @@ def process_cmdline(all_args):
     # creation of params is only one of the things this does
     params, args = controller.process_options(all_args)
 
+    if params['batch']:
+        # The commands come from the file instead
+        if args:
+            raise errors.CommandlineError("--batch can't be combined with a host pattern or action")
+        return 'batch', None, params
+
     # handle the rest of the args present after the options
     action, host_pattern = global_cmdline.process_args(args)
 
+    # An instance stays running while it reboots, so there's nothing to tell
+    # when a wave has finished restarting
+    if action == 'restart' and (params['wave_size'] or params['wave_percent']):
+        raise errors.CommandlineError("--batch-size and --batch-percent can't be used with restart, "
+                                      "because there's no way to tell when an instance has "
+                                      "finished rebooting")
+
     return action, host_pattern, params
 
 
+def create_cohort(module, profile, region, action, host_map, params, output=None,
+                  formatter=None):
+    """Creates the cohort for the hosts in one region of one account (profile),
+    which checks the region and credentials, but doesn't take any action.
+    Records describing hosts are passed to formatter (default: a table
+    written to output), and any other messages are written to output
+    (default sys.stdout).  Returns the cohort, or None if there were no hosts."""
+
+    ids = [id for id in host_map]
+    if not ids:
+        # This shouldn't happen because the map for that provider
+        # or region won't have been created by inventory.collate()
+        messages.report_notice("No hosts had correct cloud info");
+        return None
+
+    from . import rolling
+
+    cohort = rolling.make_cohort(module, action, region, ids, host_map, params, profile)
+    cohort.output = output
+    if formatter:
+        cohort.formatter = formatter
+    else:
+        cohort.formatter = formatting.make_formatter('table', action, output)
+    return cohort
+
+
+def run_cohort(cohort, provider, profile, action, params, formatter=None):
+    """Takes action on a cohort made by create_cohort(), after showing a
+    summary line."""
+
+    output = cohort.output or sys.stdout
+
+    # Show a region & provider summary line between cohorts
+    if action == "status" and params['verbose'] >= 1 and not formatter:
+        print(cohort.region, "(" + formatting.describe_provider(provider, profile) + ")",
+              file=output)
+
+    # Show a summary for actions other than status
+    if action != "status" and action != 'fullstatus' and params['verbose'] >= 1:
+        print("Running %s on instances in region %s (%s):\n  " %
+                (action, cohort.region, formatting.describe_provider(provider, profile)),
+              ", ".join(cohort.instance_ids), file=output)
+    cohort.take_action(action)
+
+
 def go(action, host_maps, params):
+    """Takes action on every region of every profile (account) of every
+    provider.  Regions are handled concurrently by up to params['parallel']
+    threads (default: one per region and profile).  Table output is shown
+    per region in the same order as a serial run would produce it; other
+    formats stream each record as soon as it's available, whichever region
+    it's from.  If params['sort'] is set, each region's records are sorted
+    and then merged into one stream.
+
+    Every cohort is created (checking its region and credentials) before
+    action is taken on any of them.  If action fails in one region, no
+    more regions are started, but those that had already started are
+    allowed to finish and their output is shown before the error is
+    raised."""
+
+    import io
+    from concurrent.futures import ThreadPoolExecutor
+
     # For each provider, this will hold a reference to the module and
     # per-region info used to track the group of hosts being acted upon
     provider_info = {}
+    jobs = []
 
     for provider in host_maps:
         provider_info[provider] = {}
@@ -103,79 +224,225 @@ def go(action, host_maps, params):
         except ImportError as e:
             raise errors.ProviderError("Unknown provider " + provider)
 
-        # take action
-        for region in host_maps[provider]:
-            assert region != 'module'
+        for profile in host_maps[provider]:
+            for region in host_maps[provider][profile]:
+                jobs.append((provider, profile, region))
+
+    if action == 'kill' and not params['confirm']:
+        # Checked here rather than by each region's cohort, so that the
+        # notice is shown once, and concurrent regions don't see it as an
+        # error
+        messages.report_notice("Not killing instances because -y wasn't specified")
+        raise SystemExit(0)
+
+    workers = params['parallel'] or len(jobs)
+    serial = workers <= 1 or len(jobs) <= 1
+
+    if params['format'] != 'table' or params['sort']:
+        # Machine-readable records say which region they're from, so cohorts
+        # share one formatter and messages go to stderr out of the way
+        shared_formatter = formatting.make_formatter(params['format'], action, params.get('records'))
+        message_output = sys.stderr
+    else:
+        shared_formatter = None
+        message_output = None
+
+    formatters = {job: shared_formatter for job in jobs}
+    if params['sort']:
+        merger = formatting.MergingFormatter(shared_formatter, params['sort'])
+        # Sources are created up front so that regions which haven't started
+        # yet hold back records that might sort after theirs
+        formatters = {job: merger.add_source(host_maps[job[0]][job[1]][job[2]]) for job in jobs}
+        shared_formatter = merger
+
+    # Table output from concurrent regions is buffered, then shown in order
+    outputs = {job: message_output if serial else (message_output or io.StringIO())
+               for job in jobs}
+
+    def create_job(provider, profile, region):
+        return create_cohort(provider_info[provider]['module'], profile, region, action,
+                             host_maps[provider][profile][region], params,
+                             outputs[(provider, profile, region)],
+                             formatters[(provider, profile, region)])
+
+    def run_job(provider, profile, region, cohort):
+        try:
+            if cohort:
+                run_cohort(cohort, provider, profile, action, params,
+                           formatters[(provider, profile, region)])
+        finally:
+            if params['sort']:
+                formatters[(provider, profile, region)].end()
 
-            # Show a region & provider summary line between cohhorts
-            if action == "status" and params['verbose'] >= 1:
-                print(region, "(" + provider + ")")
+    try:
+        # take action; cohorts are stored by (profile, region)
+        if serial:
+            cohorts = [create_job(*job) for job in jobs]
+            for job, cohort in zip(jobs, cohorts):
+                run_job(*(job + (cohort,)))
+                if cohort:
+                    provider_info[job[0]][job[1:]] = cohort
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # Create every cohort first, so that a bad region or credentials
+                # stop the run before anything has been done; the first error
+                # in job order is the one that a serial run would have raised
+                futures = [executor.submit(create_job, *job) for job in jobs]
+                cohorts = [future.exception() or future.result() for future in futures]
+                for cohort in cohorts:
+                    if isinstance(cohort, BaseException):
+                        raise cohort
+
+                futures = [executor.submit(run_job, *(job + (cohort,)))
+                           for job, cohort in zip(jobs, cohorts)]
+
+                # Collect results in submission order, so each region's output
+                # is shown in one piece and exceptions are raised in the same
+                # order that a serial run would have raised them
+                error = None
+                for job, cohort, future in zip(jobs, cohorts, futures):
+                    try:
+                        if not future.cancelled():
+                            future.result()
+                            if cohort:
+                                provider_info[job[0]][job[1:]] = cohort
+                    except BaseException as e:
+                        if error is None:
+                            error = e
+                            # Don't start on regions that haven't been reached
+                            # yet, but let those already under way finish
+                            for other in futures:
+                                other.cancel()
+                        elif not isinstance(e, SystemExit):
+                            messages.report_error("%s (%s): %s" %
+                                                  (job[2], formatting.describe_provider(job[0], job[1]),
+                                                   e))
+                    finally:
+                        if not message_output:
+                            sys.stdout.write(outputs[job].getvalue())
+                            sys.stdout.flush()
+                if error is not None:
+                    raise error
+    finally:
+        if params['sort']:
+            # Show what was collected from the regions that did take action
+            merger.flush()
+        # Even after an error, so that e.g. a JSON list is terminated
+        if shared_formatter:
+            shared_formatter.end()
 
-            ids = [id for id in host_maps[provider][region]]
-            if ids:
-                provider_info[provider][region] = \
-                  provider_info[provider]['module'].PerRegionCohort(region, ids, \
-                                                      host_maps[provider][region], params)
+    return provider_info
 
-                # Show a summary for actions other than status
-                if action != "status" and action != 'fullstatus' and params['verbose'] >= 1:
-                    print("Running %s on instances in region %s (%s):\n  " % (action, region, provider), ", ".join(ids))
-                provider_info[provider][region].take_action(action)
-            else:
-                # This shouldn't happen because the map for that provider
-                # or region won't have been created by inventory.collate()
-                messages.report_notice("No hosts had correct cloud info");
 
-    return provider_info
+def poll(action, host_maps, provider_info, params):
+    """Waits for every cohort to reach the state implied by the action, or
+    for params['timeout'] seconds to elapse.  Returns the number of instances
+    that didn't get there."""
 
+    from .polling import Poller, timeout_for
 
-def poll(host_maps, provider_info, params):
-    import time
+    timeout = timeout_for(params)
 
     if params['debug']:
-        print("Polling every %d seconds, up to %d times" % (params['poll_interval'], params['max_poll']))
-
-    iterations = 0
-    while iterations < params['max_poll']:
-        undesired_count = 0
-        for provider in host_maps:
-            for region in host_maps[provider]:
-                cohort = provider_info[provider][region]
-                undesired_count += cohort.num_deviants(iterations == 0)
-        if undesired_count == 0:
-            break
-        else:
-            time.sleep(params['poll_interval'])
+        print("Polling at most every %d seconds, for up to %d seconds" % (params['poll_interval'], timeout))
 
-        if params['verbose'] >= 2:
-            # Show a line of progress dots.  Don't use 'print' because it adds a space.
-            sys.stdout.write(".")
-            sys.stdout.flush()
-        iterations += 1
+    cohorts = []
+    for provider in host_maps:
+        for profile in host_maps[provider]:
+            for region in host_maps[provider][profile]:
+                cohorts.append(provider_info[provider][(profile, region)])
 
-        # TO-DO: optionally relist
+    # Keep progress messages out of machine-readable output
+    if params['format'] != 'table':
+        output = sys.stderr
+    else:
+        output = sys.stdout
+
+    poller = Poller(action, params['poll_interval'], timeout, params['verbose'], output)
+    undesired_count = poller.run(cohorts)
 
     # newline for the dots that were printed
     if params['verbose'] >= 2:
-        if iterations == 0:
-            print("No action required.")
+        if not any(cohort.action_required() for cohort in cohorts):
+            print(" No action required.", file=output)
         else:
             if undesired_count == 0:
-                print(" Complete.")
+                print(" Complete.", file=output)
+            else:
+                print(" Giving up.", file=output)
+
+    return undesired_count
+
+
+def count_failures(provider_info):
+    """Returns the number of instances that the action couldn't be taken on."""
+    count = 0
+    for provider in provider_info:
+        for key, cohort in provider_info[provider].items():
+            if key != 'module':
+                count += len(cohort.failures)
+    return count
+
+
+def show_stats(params):
+    """Shows the API statistics collected by each provider (on stderr) and/or
+    writes them to a JSON file, as requested."""
+
+    if params['stats']:
+        for provider, stats in sorted(params['api_stats'].items()):
+            print("API requests (%s):" % provider, file=sys.stderr)
+            stats.show(sys.stderr)
+
+    if params['stats_file']:
+        import json
+
+        data = {provider: stats.as_dict() for provider, stats in params['api_stats'].items()}
+        try:
+            if params['stats_file'] == '-':
+                json.dump(data, sys.stdout, indent=2, sort_keys=True)
+                print()
             else:
-                print(" Giving up.")
+                with open(params['stats_file'], 'w') as f:
+                    json.dump(data, f, indent=2, sort_keys=True)
+                    f.write("\n")
+        except OSError as e:
+            messages.report_error("Can't write statistics: " + str(e))
 
 
 def main():
     """Acts like main() in a C program.  Return value is used as program exit code."""
 
+    return run(sys.argv[1:])
+
+
+def run(all_args, records=None):
+    """Does everything for one command line (minus the program name) and
+    returns the exit code.  If records is a list, records describing hosts are
+    appended to it instead of being shown as a table; see shepherd.batch."""
+
     try:
-        action, host_pattern, params = process_cmdline(sys.argv[1:])
+        action, host_pattern, params = process_cmdline(all_args)
     except errors.CommandlineError as e:
         messages.report_error(str(e))
         global_cmdline.show_help(sys.stderr)
         return 1
 
+    if action == 'batch' or action == 'serve':
+        if records is not None:
+            messages.report_error("Batch mode and serve can't be used by batch commands")
+            return 1
+
+        from . import batch
+        if action == 'batch':
+            return batch.run_batch(params['batch'], batch.base_args(all_args))
+        else:
+            return batch.serve(params['socket'] or batch.default_socket_path(),
+                               batch.base_args(all_args))
+
+    if records is not None and params['format'] == 'table':
+        params['format'] = 'records'
+        params['records'] = records
+
     # self.params['verbose'] governs logging within the program, but
     # self.params['debug'] governs the root logger
     if params['debug'] >= 2:
@@ -185,7 +452,7 @@ def main():
     else:
         global_loglevel = logging.WARNING
     if params['logfile']:
-        logging.basicConfig(level=global_loglevel, filename=self.params['logfile'])
+        logging.basicConfig(level=global_loglevel, filename=params['logfile'])
     else:
         logging.basicConfig(level=global_loglevel)
 
@@ -202,8 +469,11 @@ def main():
 
     try:
         host_maps = inventory.collate(host_pattern, 
-                                      params['inventory_filename'],
-                                      params['logger'])
+                                      params['inventory_paths'],
+                                      params['logger'],
+                                      params['inventory_cache'],
+                                      action == 'fullstatus',
+                                      params['inventory_ttl'])
     except inventory.NoHostsError as e:
         messages.report_notice("No instances matched");
         return 0
@@ -215,10 +485,23 @@ def main():
         return 6
 
     try:
-        provider_info = go(action, host_maps, params)
+        if action == 'watch':
+            from . import watch
+            watch.run(host_maps, params)
+            return 0
+
+        if params['engine'] == 'asyncio':
+            from . import engine
+            provider_info = engine.run(action, host_maps, params)
+        else:
+            provider_info = go(action, host_maps, params)
+
+            if params['poll'] and action != "status" and not params['dry_run']:
+                poll(action, host_maps, provider_info, params)
 
-        if params['poll'] and action != "status" and not params['dry_run']:
-            poll(host_maps, provider_info, params)
+        if count_failures(provider_info):
+            # Errors already reported
+            return 4
     except errors.ProviderError as e:
         messages.report_error(str(e))
         return 5
@@ -238,6 +521,11 @@ def main():
     except socket.gaierror as e:
         messages.report_error("Can't connect to endpoint: " + str(e))
         return 8
+    except KeyboardInterrupt:
+        # Anything worth knowing has already been reported
+        return 130
+    finally:
+        show_stats(params)
 
 
 def action_debug(all_args):
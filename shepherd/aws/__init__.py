@@ -3,13 +3,13 @@
 
 
 import re
-import boto3
-import botocore.exceptions
 
 from .. import errors
-from .. import formatting
 from .. import provider
 from ..utils import messages
+from ..utils import resolver
+from ..utils import statecache
+from . import ratelimit
 
 
 # -- API request/response stuff --
@@ -26,6 +26,29 @@ EC2_STATE_STOPPING      = 64
 EC2_STATE_STOPPED       = 80
 EC2_STATE_NONE          = -1
 
+# The client method used for each action, and the key for the list of
+# instances (with their new states) in its response
+ACTION_REQUESTS = {'start':   ('start_instances', 'StartingInstances'),
+                   'restart': ('reboot_instances', None),
+                   'stop':    ('stop_instances', 'StoppingInstances'),
+                   'kill':    ('terminate_instances', 'TerminatingInstances')}
+
+# Errors caused by particular instances in a request, as opposed to the
+# request as a whole; the remaining instances can still be acted upon
+INSTANCE_ERROR_CODES = ("InvalidInstanceID.NotFound",
+                        "InvalidInstanceID.Malformed",
+                        "IncorrectInstanceState",
+                        "UnsupportedOperation",
+                        "OperationNotPermitted")
+
+# Options that limit which instances are shown, and the instance states
+# (as used by the instance-state-name filter) that each one allows
+STATE_FILTER_PARAMS = {'only_running': ('running',),
+                       'only_stopped': ('stopped',)}
+
+# Number of requests for chunks of a cohort that can be in progress at once
+CHUNK_WORKERS = 4
+
 ACTION_STATE_MAP = {'status':      EC2_STATE_NONE,
                     'fullstatus':  EC2_STATE_NONE,
                     'start':       EC2_STATE_RUNNING,
@@ -33,152 +56,194 @@ ACTION_STATE_MAP = {'status':      EC2_STATE_NONE,
                     'stop':        EC2_STATE_STOPPED,
                     'kill':        EC2_STATE_TERMINATED}
 
-boto_session = None
+# botocore takes a long time to import, so it's only loaded by init(), i.e.
+# once some hosts are known to belong to this provider
+botocore = None
+
+# Shared by all cohorts; see pool.SessionPool
+session_pool = None
+# Used for hosts with a public IP but no public DNS name, unless disabled
+reverse_resolver = None
+# Last-seen instance records, for status/fullstatus; see utils.statecache
+state_cache = None
+# Counts and times of API requests, if wanted; see stats.ApiStats
+api_stats = None
+# Regions that cohorts can be in; see regions.RegionList
+region_list = None
 
 __all__ = []
 
 
 # *** CLASSES ***
 class PerRegionCohort(provider.Cohort):
-    instances = None
     desired_state = EC2_STATE_NONE
-
-    def __init__(self, region, ids, host_map, params):
+    # IDs of the instances that haven't reached desired_state yet (None
+    # until the first poll)
+    pending_ids = None
+    # See act()
+    outcomes = None
+    previous_states = None
+
+    def __init__(self, region, ids, host_map, params, profile=None):
         """@param host_map is the mapping, for all specified hosts in this
-        region, of instance ID to Ansible inventory object."""
+        region, of instance ID to inventory.HostRecord.
+        @param profile is the AWS profile, or None for params['aws_profile']."""
 
-        super(PerRegionCohort, self).__init__(region, ids, host_map, params)
+        super(PerRegionCohort, self).__init__(region, ids, host_map, params,
+                                              profile or params['aws_profile'])
 
         # Validate the public cloud region to avoid a
         # botocore.exceptions.EndpointConnectionError
-        if not region in params['aws_regions']:
+        if not region_list.check(region, session_pool.session(self.profile)):
             raise errors.ProviderError("Unknown cloud region " + region)
 
-        try:
-            self.ec2 = boto_session.resource("ec2", region_name=region)
-            # Force an API request to validate the credentials
-            vpcs = self.ec2.vpcs.all()
-            ## list((iter(vpcs)))
-                # No VPCs
-        except botocore.exceptions.EndpointConnectionError as e:
-            raise errors.NetworkError("timeout or connection error")
-        except botocore.exceptions.ClientError:
-            raise errors.AuthError("Permission denied")
-        except botocore.exceptions.NoCredentialsError:
-            raise errors.AuthError("No credentials")
-
-
-    def populate(self):
-        if not self.instances:
-            self.instances = self.ec2.instances.filter(InstanceIds=self.instance_ids)
+        # Make an API request to validate the credentials, unless that's
+        # already been done in another region
+        session_pool.validate(self.profile, region)
+        self.client = session_pool.client(self.profile, region)
+
+        # Name tags of VPCs and subnets that have been looked up, keyed by ID
+        self.vpc_names = {}
+        self.subnet_names = {}
+        # Instances that current_states() found don't exist (any more)
+        self.missing_ids = set()
+
+
+    def iter_batches(self):
+        """Yields lists of records (see instance_record()) for the instances
+        in the cohort, a batch at a time so they can be output before the
+        whole region has been described.  Records in the state cache that are
+        fresh enough come first; the rest are described chunk by chunk."""
+
+        cached = {}
+        if state_cache:
+            cached = state_cache.get_fresh(self.instance_ids)
+            if cached:
+                yield [cached[id] for id in self.instance_ids if id in cached]
+
+        missing_ids = [id for id in self.instance_ids if id not in cached]
+
+        # Have the API leave out instances that wouldn't be shown anyway
+        kwargs = {}
+        state_names = allowed_state_names(self.global_params)
+        if state_names is not None:
+            if not state_names:
+                return
+            kwargs['Filters'] = [{'Name': 'instance-state-name', 'Values': state_names}]
+
+        size = self.global_params['chunk_size']
+        for n in range(0, len(missing_ids), size):
+            batch = []
+            paginator = self.client.get_paginator('describe_instances')
+            for page in paginator.paginate(InstanceIds=missing_ids[n:n + size], **kwargs):
+                for reservation in page['Reservations']:
+                    for item in reservation['Instances']:
+                        record = instance_record(item)
+                        record['fetched'] = True
+                        batch.append(record)
+            yield batch
+
+
+    def load_network_names(self, instances):
+        """Fills in the Name tags of the VPC and subnet in every instance
+        record that doesn't already have them.  Each VPC and subnet is only
+        looked up once per cohort, and all of those in a batch are looked up
+        with one DescribeVpcs and one DescribeSubnets request."""
+
+        vpc_ids = sorted(set(i['vpc_id'] for i in instances
+                             if i['vpc_id'] and 'vpc_name' not in i and
+                                i['vpc_id'] not in self.vpc_names))
+        subnet_ids = sorted(set(i['subnet_id'] for i in instances
+                                if i['subnet_id'] and 'subnet_name' not in i and
+                                   i['subnet_id'] not in self.subnet_names))
+
+        if vpc_ids:
+            paginator = self.client.get_paginator('describe_vpcs')
+            for page in paginator.paginate(VpcIds=vpc_ids):
+                for vpc in page['Vpcs']:
+                    self.vpc_names[vpc['VpcId']] = get_name_tag(vpc)
+        if subnet_ids:
+            paginator = self.client.get_paginator('describe_subnets')
+            for page in paginator.paginate(SubnetIds=subnet_ids):
+                for subnet in page['Subnets']:
+                    self.subnet_names[subnet['SubnetId']] = get_name_tag(subnet)
+
+        for instance in instances:
+            if instance['vpc_id'] in self.vpc_names:
+                instance['vpc_name'] = self.vpc_names[instance['vpc_id']]
+            if instance['subnet_id'] in self.subnet_names:
+                instance['subnet_name'] = self.subnet_names[instance['subnet_id']]
 
 
     def show_host(self, instance, action):
-        host = self.host_map[instance.id]
-
-        state = self.convert_state(instance.state)
-
-        if action == 'status':
-            # TO-DO: Return a tuple instead
-            # Used to be "%s \t%s\t%s"
-            formatting.print_host(host.name, instance.id, state)
-        elif action == 'fullstatus':
-            # à la knife node show
-            # TO-DO: Ansible groups, EC2 tags
-            info = { 'az': instance.placement['AvailabilityZone'],
-                     'image_id': instance.image_id,
-                     'instance_type': instance.instance_type,
-                     'launch_time': instance.launch_time,
-                     'private_ip': instance.private_ip_address }
-            if instance.ipv6_address:
-                info['ipv6'] = instance.ipv6_address
-            if instance.public_ip_address:
-                info['public_ip'] = instance.public_ip_address
-                if instance.public_dns_name:
-                    info['fqdn'] = instance.public_dns_name
-                else:
+        """Passes a record describing the host to the formatter."""
+
+        host = self.host_map[instance['id']]
+        record = { 'name': host.name,
+                   'id': instance['id'],
+                   'state': self.convert_state(instance['state']),
+                   'provider': 'aws',
+                   'region': self.region }
+
+        if action == 'fullstatus':
+            # TO-DO: EC2 tags
+            record['groups'] = host.groups
+            for field in ('instance_type', 'az', 'public_ip', 'private_ip', 'ipv6',
+                          'vpc_id', 'vpc_name', 'subnet_id', 'subnet_name',
+                          'launch_time', 'image_id'):
+                record[field] = instance.get(field) or None
+            if instance['public_ip']:
+                if instance['public_dns']:
+                    record['fqdn'] = instance['public_dns']
+                elif reverse_resolver:
                     # Reverse-resolve the public IP and use that for the FQDN
-                    import socket
-                    addr_info = socket.gethostbyaddr(instance.public_ip_address)
-                    info['fqdn'] = addr_info[0]
-
-            if instance.vpc_id:
-                ## template += """
-                ##             VPC: {vpc_id} (<name>), {subnet_id} (<name>)""".format(subnet_id=instance.subnet_id,
-                ##                                                                subnet_name="",
-                ##                                                                vpc_id=instance.vpc_id,
-                ##                                                                vpc_name="")
-                info['vpc_info'] = instance.vpc_id
-                vpcs = self.ec2.vpcs.filter(VpcIds=[instance.vpc_id])
-                i_vpc = next(iter(vpcs))
-                if i_vpc.tags and 'Name' in i_vpc.tags:
-                    info['vpc_info'] += " (%s)" % i_vpc.tags['Name']
-                info['vpc_info'] += ", " + instance.subnet_id
-                if instance.subnet.tags and 'Name' in instance.subnet.tags:
-                    info['vpc_info'] += " (%s)" % instance.subnet.tags['Name']
-
-            # Templates have everything starting on column 0, like for the output
-            # (Backslashes avoid leading newline.)
-            # TO-DO: use Jinja2 or something instead
-            if 'fqdn' in info:
-                template = """\
-FQDN: {fqdn}
-"""
-            else:
-                template = ""
+                    record['fqdn'] = reverse_resolver.lookup(instance['public_ip'])
 
-            template += """\
-Instance type: {instance_type}
-Location:      {az} (availability zone)
-IP addrs:      """
-
-            # Addresses
-            if 'public_ip' in info:
-                template += "{public_ip} "
-            template += "{private_ip}"
-            if 'ipv6' in info:
-                template += " {ipv6}"
-
-            if 'vpc_info' in info:
-                template += """
-VPC: {vpc_info}"""
-            template += """
-Launch time:   {launch_time} from AMI: {image_id}"""
-
-            formatting.print_host(host.name, instance.id, state,
-                                  template.format(**info))
+        self.formatter.write(record)
 
 
     def take_action(self, action):
         super(PerRegionCohort, self).take_action(action)
 
         self.desired_state = ACTION_STATE_MAP[action]
-        
-        d = self.global_params['dry_run']
 
         try:
             if action == 'status' or action == 'fullstatus':
-                self.populate()
-                for instance in self.instances:
-                    # List the instance, unless its state doesn't match a
-                    # limitation that's in force
-                    if (instance.state['Code'] == EC2_STATE_RUNNING or not self.global_params['only_running']) and \
-                       (instance.state['Code'] == EC2_STATE_STOPPED or not self.global_params['only_stopped']):
-                        # Look up the inventory object from the EC2 object's ID
-                        self.show_host(instance, action)
-
-            elif action == 'start':
-                self.ec2.instances.filter(InstanceIds=self.instance_ids).start(DryRun=d)
-            elif action == 'stop':
-                self.ec2.instances.filter(InstanceIds=self.instance_ids).stop(DryRun=d)
-            elif action == 'restart':
-                self.ec2.instances.filter(InstanceIds=self.instance_ids).reboot(DryRun=d)
-            elif action == 'kill':
-                if self.global_params['confirm']:
-                    self.ec2.instances.filter(InstanceIds=self.instance_ids).terminate(DryRun=d)
-                else:
+                for batch in self.iter_batches():
+                    if action == 'fullstatus':
+                        self.load_network_names(batch)
+                        if reverse_resolver:
+                            # Get all the reverse lookups going at once
+                            reverse_resolver.prefetch([i['public_ip'] for i in batch
+                                                       if i['public_ip'] and not i['public_dns']])
+                    if state_cache:
+                        fetched = [i for i in batch if i.pop('fetched', False)]
+                        state_cache.update(fetched)
+                        if action == 'fullstatus' and len(fetched) < len(batch):
+                            # Store the network names added to records from
+                            # the cache, without refreshing them
+                            fetched_ids = set(i['id'] for i in fetched)
+                            state_cache.update([i for i in batch if i['id'] not in fetched_ids],
+                                               keep_time=True)
+
+                    for instance in batch:
+                        # List the instance, unless its state doesn't match a
+                        # limitation that's in force
+                        if (instance['state']['Code'] == EC2_STATE_RUNNING or not self.global_params['only_running']) and \
+                           (instance['state']['Code'] == EC2_STATE_STOPPED or not self.global_params['only_stopped']):
+                            # Look up the inventory object from the EC2 object's ID
+                            self.show_host(instance, action)
+
+                if state_cache:
+                    state_cache.save()
+                if reverse_resolver:
+                    reverse_resolver.save()
+
+            elif action in ACTION_REQUESTS:
+                if action == 'kill' and not self.global_params['confirm']:
                     messages.report_notice("Not killing instances because -y wasn't specified")
                     raise SystemExit(0)
+                self.act(action)
             else:
                 raise errors.ActionError("Unknown action '%s'" % (action,))
         except botocore.exceptions.EndpointConnectionError as e:
@@ -198,38 +263,208 @@ Launch time:   {launch_time} from AMI: {image_id}"""
                 raise
 
 
+    def act(self, action):
+        """Takes the action on all instances in the cohort, by splitting them
+        into chunks and sending requests for several chunks at once.  A chunk
+        that's rejected because of some of its instances is bisected until
+        they're isolated, so the action is still taken on the rest.
+
+        Afterwards, self.outcomes maps each instance ID to (success, new state
+        or error message), self.previous_states maps each instance that EC2
+        reported on to its state code beforehand, and any failed instances
+        are listed in self.failures and dropped from self.instance_ids."""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        size = self.global_params['chunk_size']
+        chunks = [self.instance_ids[n:n + size] for n in range(0, len(self.instance_ids), size)]
+
+        self.outcomes = {}
+        self.previous_states = {}
+        if len(chunks) == 1:
+            self.outcomes.update(self.act_on_chunk(action, chunks[0]))
+        else:
+            with ThreadPoolExecutor(max_workers=min(CHUNK_WORKERS, len(chunks))) as executor:
+                futures = [executor.submit(self.act_on_chunk, action, chunk) for chunk in chunks]
+                try:
+                    for future in futures:
+                        self.outcomes.update(future.result())
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+        # Report per-instance outcomes
+        for id in self.instance_ids:
+            succeeded, description = self.outcomes[id]
+            host = self.host_map[id]
+            if not succeeded:
+                self.failures[id] = description
+                messages.report_error("%s (%s): %s" % (host.name, id, description))
+            elif self.global_params['verbose'] >= 2:
+                self.formatter.write({'name': host.name, 'id': id, 'state': description,
+                                      'provider': 'aws', 'region': self.region})
+
+        self.instance_ids = [id for id in self.instance_ids if id not in self.failures]
+
+        # Whatever was cached about these instances is now out of date
+        if state_cache and not self.global_params['dry_run']:
+            state_cache.invalidate(self.instance_ids)
+            state_cache.save()
+
+
+    def act_on_chunk(self, action, ids):
+        """Sends the request for the action on the given instances.  Returns a
+        mapping of instance ID to (success, new state or error message)."""
+
+        method_name, response_key = ACTION_REQUESTS[action]
+        try:
+            response = getattr(self.client, method_name)(InstanceIds=ids,
+                                                         DryRun=self.global_params['dry_run'])
+        except botocore.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            if code == "DryRunOperation":
+                # Equivalent to HTTP code 412, "Precondition Failed"
+                self.logger.info(str(e.response['Error']['Message']))
+                return {id: (True, "dry run") for id in ids}
+            elif code in ratelimit.THROTTLING_ERROR_CODES:
+                # Still throttled after botocore's retries; the other chunks
+                # can carry on regardless
+                return {id: (False, str(e.response['Error']['Message'])) for id in ids}
+            elif code in INSTANCE_ERROR_CODES:
+                if len(ids) == 1:
+                    return {ids[0]: (False, str(e.response['Error']['Message']))}
+                half = len(ids) // 2
+                outcomes = self.act_on_chunk(action, ids[:half])
+                outcomes.update(self.act_on_chunk(action, ids[half:]))
+                return outcomes
+            else:
+                raise
+
+        if response_key:
+            for item in response[response_key]:
+                self.previous_states[item['InstanceId']] = item['PreviousState']['Code']
+            return {item['InstanceId']: (True, self.convert_state(item['CurrentState']))
+                    for item in response[response_key]}
+        else:
+            # RebootInstances doesn't return anything
+            return {id: (True, "rebooting") for id in ids}
+
+
+    def fetch_states(self, ids):
+        """Returns a mapping of instance ID to EC2 state dict for the given
+        instances, all fetched with one (paginated) DescribeInstances request."""
+
+        states = {}
+        try:
+            paginator = self.client.get_paginator('describe_instances')
+            for page in paginator.paginate(InstanceIds=ids):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        states[instance['InstanceId']] = instance['State']
+        except botocore.exceptions.EndpointConnectionError as e:
+            raise errors.NetworkError("timeout or connection error")
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == "InvalidInstanceID.NotFound":
+                raise errors.InstanceError(str(e.response['Error']['Message'])) from e
+            else:
+                raise
+        return states
+
+
+    def current_states(self):
+        # One (paginated) request for the whole cohort, unless some of the
+        # instances don't exist
+        ids = [id for id in self.instance_ids if id not in self.missing_ids]
+        try:
+            states = self.fetch_existing_states(ids)
+        except botocore.exceptions.ClientError as e:
+            raise errors.RequestError(str(e.response['Error']['Message'])) from e
+        return {id: self.convert_state(state) for id, state in states.items()}
+
+
+    def fetch_existing_states(self, ids):
+        """Like fetch_states(), but instances that don't exist (e.g. because
+        they were terminated a while ago) are left out and added to
+        self.missing_ids.  They're found by bisecting the request, since EC2
+        rejects the whole request because of them."""
+
+        if not ids:
+            # Otherwise every instance in the region would be described
+            return {}
+        try:
+            return self.fetch_states(ids)
+        except errors.InstanceError:
+            if len(ids) == 1:
+                self.missing_ids.add(ids[0])
+                return {}
+            half = len(ids) // 2
+            states = self.fetch_existing_states(ids[:half])
+            states.update(self.fetch_existing_states(ids[half:]))
+            return states
+
+
     def num_deviants(self, first_run):
         """Used during polling.  Returns the number of instances in a given
-        cohort that don't match the state indicated by the given action."""
+        cohort that don't match the state indicated by the given action.
 
-        self.populate()
+        The states of the whole cohort are refreshed with a single request,
+        and instances that have reached the desired state are left out of
+        subsequent requests."""
+
+        if self.pending_ids is None:
+            self.pending_ids = list(self.instance_ids)
+        if not self.pending_ids:
+            return 0
+
+        states = self.fetch_states(self.pending_ids)
 
         # Check current state of the instances in the cohort
-        undesired_count = 0
+        still_pending = []
         if self.global_params['debug']:
             print('[%d:]' % self.desired_state, end=' ')
-        for instance in self.instances:
-            if not first_run:
-                try:
-                    instance.load()
-                except ValueError:
-                    raise errors.InstanceError("instance no longer exists; instance ID = ",
-                                               instance.id)
-            if instance.state['Code'] != self.desired_state:
-                undesired_count += 1
+        for id in self.pending_ids:
+            try:
+                state = states[id]
+            except KeyError:
+                raise errors.InstanceError("instance no longer exists; instance ID = " + id)
+            if state['Code'] != self.desired_state:
+                still_pending.append(id)
                 if self.global_params['debug']:
-                    print('[%d != %d]' % (instance.state['Code'],
+                    print('[%d != %d]' % (state['Code'],
                                           self.desired_state),
                                           end=' ')
             else:
                 if self.global_params['debug']:
-                    print('[%d]' % instance.state['Code'], end=' ')
-            # previous_state_code
+                    print('[%d]' % state['Code'], end=' ')
+        self.pending_ids = still_pending
 
         if self.global_params['debug']:
-            print("%d deviants in AWS region %s" % (undesired_count, self.region))
+            print("%d deviants in AWS region %s" % (len(still_pending), self.region))
+
+        return len(still_pending)
+
+
+    def action_required(self):
+        # Reboots don't report the previous state, and always change
+        # something anyway
+        previous_states = self.previous_states or {}
+        return any(previous_states.get(id) != self.desired_state
+                   for id in self.instance_ids)
+
 
-        return undesired_count
+    def instance_status(self, id):
+        status = super(PerRegionCohort, self).instance_status(id)
+        if status:
+            return status
+        if self.pending_ids is not None:
+            if id in self.pending_ids:
+                return "requested, still changing state"
+            else:
+                return "done"
+        if self.outcomes and id in self.outcomes:
+            return "requested (%s)" % self.outcomes[id][1]
+        return None
 
 
     @classmethod
@@ -243,12 +478,77 @@ Launch time:   {launch_time} from AMI: {image_id}"""
 
 
 # *** FUNCTIONS ***
-def init(params):
-    global boto_session
+def instance_record(item):
+    """Converts an instance in a DescribeInstances response into a dict with
+    just the things shepherd shows, in a form that can be cached as JSON."""
+    return { 'id': item['InstanceId'],
+             'state': {'Code': item['State']['Code'], 'Name': item['State']['Name']},
+             'az': item['Placement']['AvailabilityZone'],
+             'image_id': item.get('ImageId'),
+             'instance_type': item.get('InstanceType'),
+             'launch_time': str(item.get('LaunchTime')),
+             'private_ip': item.get('PrivateIpAddress'),
+             'ipv6': item.get('Ipv6Address'),
+             'public_ip': item.get('PublicIpAddress'),
+             'public_dns': item.get('PublicDnsName'),
+             'vpc_id': item.get('VpcId'),
+             'subnet_id': item.get('SubnetId') }
+
+
+def allowed_state_names(params):
+    """Returns a list of the instance state names that can be shown, given the
+    options in force, or None if any state can be shown."""
+    allowed = None
+    for param, state_names in STATE_FILTER_PARAMS.items():
+        if params[param]:
+            if allowed is None:
+                allowed = set(state_names)
+            else:
+                allowed &= set(state_names)
+    if allowed is None:
+        return None
+    return sorted(allowed)
+
 
-    if params['aws_profile']:
-        boto_session = boto3.session.Session(profile_name=params['aws_profile'])
-    else:
-        boto_session = boto3.session.Session()
+def get_name_tag(item):
+    """Returns the value of the Name tag in an API response item (e.g. a VPC),
+    or None if there isn't one."""
+    for tag in item.get('Tags', []):
+        if tag['Key'] == 'Name':
+            return tag['Value']
+    return None
 
-    params['aws_regions'] = boto_session.get_available_regions("ec2")
+
+def init(params):
+    global session_pool, reverse_resolver, state_cache, api_stats, region_list, botocore
+
+    import botocore.exceptions
+    from . import pool
+    from . import regions
+
+    # These are kept for any later commands run by the same process (see
+    # shepherd.batch), unless the options they depend on have changed
+    if not session_pool:
+        # Each region's client is shared by that cohort's chunk requests, and
+        # requests for every cohort share the rate limits
+        session_pool = pool.SessionPool(CHUNK_WORKERS, limiter=ratelimit.RateLimiter())
+    session_pool.limiter.set_rates(params['aws_rates'] or ratelimit.DEFAULT_RATES)
+    if params['stats'] or params['stats_file']:
+        if not api_stats:
+            from .stats import ApiStats
+            api_stats = ApiStats()
+            session_pool.collect_stats(api_stats)
+        else:
+            # Only count this command's requests
+            api_stats.reset()
+        params['api_stats']['aws'] = api_stats
+    if not params['reverse_dns']:
+        reverse_resolver = None
+    elif not reverse_resolver or reverse_resolver.ttl != params['ptr_ttl']:
+        reverse_resolver = resolver.ReverseResolver(ttl=params['ptr_ttl'])
+    if not state_cache or state_cache.ttl != params['state_ttl'] or state_cache.fresh != params['fresh']:
+        # Even with the TTL at 0 (i.e. not reading the cache), this is still
+        # needed to invalidate the entries for instances that are acted upon
+        state_cache = statecache.StateCache(params['state_ttl'], params['fresh'])
+    if not region_list:
+        region_list = regions.RegionList()
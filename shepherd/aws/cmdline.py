@@ -3,10 +3,11 @@
 import os
 
 from ..utils.cmdline_controller import Handler
+from .. import errors
 
 
 extra_options = 'p:'
-extra_long_options=['profile=']
+extra_long_options=['profile=', 'rate-limit=']
 
 cmdline_handler = None
 
@@ -23,6 +24,17 @@ class MyHandler(Handler):
         if option == "-p" or option == "--profile":
             self.params['profile'] = opt_arg
             return True
+        elif option == "--rate-limit":
+            # Requests per second for describe and mutate requests, or the
+            # same for both
+            try:
+                rates = [float(rate) for rate in opt_arg.split(",")]
+            except ValueError:
+                rates = []
+            if len(rates) not in (1, 2) or min(rates) < 0:
+                raise errors.CommandlineError("Invalid rate limit '%s'" % opt_arg)
+            self.params['rates'] = {'describe': rates[0], 'mutate': rates[-1]}
+            return True
         else:
             return False
 
@@ -45,6 +57,7 @@ class MyHandler(Handler):
                 profile = env_profile
 
         data['aws_profile'] = profile
+        data['aws_rates'] = self.params['rates']
         return data
 
 
@@ -0,0 +1,92 @@
+"""A cut-down copy of botocore's EC2 service model, with just the operations
+that shepherd uses.  The full model has hundreds of operations and loading it
+takes most of the time before the first API request; the copy is a tiny
+fraction of the size.  botocore finds it because the data directory is put at
+the front of each session's search path.  If botocore has a newer version of
+the EC2 API than the copy, its own model is used instead.
+
+After adding an operation or upgrading botocore, regenerate the copy with
+"make ec2-model" (i.e. python -m shepherd.aws.models)."""
+
+
+import os
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+# Every EC2 operation that shepherd's clients call
+OPERATIONS = ('DescribeInstances', 'StartInstances', 'StopInstances', 'RebootInstances',
+              'TerminateInstances', 'DescribeVpcs', 'DescribeSubnets')
+
+
+# *** FUNCTIONS ***
+def use_bundled_models(session):
+    """Makes a botocore session look for service models in DATA_DIR first."""
+    if os.path.isdir(DATA_DIR):
+        search_paths = session.get_component('data_loader').search_paths
+        if DATA_DIR not in search_paths:
+            search_paths.insert(0, DATA_DIR)
+
+
+def prune(model, operations):
+    """Returns a copy of a service model with just the given operations, the
+    shapes that they refer to, and no documentation."""
+
+    shapes = set()
+
+    def add_shape(name):
+        if name in shapes:
+            return
+        shapes.add(name)
+        shape = model['shapes'][name]
+        for key in ('member', 'key', 'value'):
+            if key in shape:
+                add_shape(shape[key]['shape'])
+        for member in shape.get('members', {}).values():
+            add_shape(member['shape'])
+
+    for name in operations:
+        operation = model['operations'][name]
+        for key in ('input', 'output'):
+            if key in operation:
+                add_shape(operation[key]['shape'])
+        for error in operation.get('errors', []):
+            add_shape(error['shape'])
+
+    return strip_documentation(dict(model,
+                                    operations={name: model['operations'][name] for name in operations},
+                                    shapes={name: model['shapes'][name] for name in sorted(shapes)}))
+
+
+def strip_documentation(item):
+    if isinstance(item, dict):
+        return {key: strip_documentation(value) for key, value in item.items()
+                if key not in ('documentation', 'documentationUrl')}
+    elif isinstance(item, list):
+        return [strip_documentation(value) for value in item]
+    else:
+        return item
+
+
+def main():
+    """Writes the cut-down EC2 model, from the installed botocore's."""
+    import json
+    import shutil
+    import botocore.session
+
+    loader = botocore.session.Session().get_component('data_loader')
+    api_version = loader.determine_latest_version('ec2', 'service-2')
+    model = loader.load_service_model('ec2', 'service-2', api_version)
+
+    # Only one version is wanted
+    shutil.rmtree(os.path.join(DATA_DIR, "ec2"), ignore_errors=True)
+    directory = os.path.join(DATA_DIR, "ec2", api_version)
+    os.makedirs(directory)
+    with open(os.path.join(directory, "service-2.json"), 'w') as f:
+        json.dump(prune(model, OPERATIONS), f, indent=1, sort_keys=True)
+        f.write("\n")
+    print("Wrote %s (API version %s)" % (directory, api_version))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Sessions and clients shared by every AWS cohort.  These are botocore's
+own, since boto3 only adds things that shepherd doesn't use (like the
+resource layer), at the cost of more importing and loading."""
+
+
+import threading
+
+import botocore.config
+import botocore.exceptions
+import botocore.session
+
+from .. import errors
+from . import models
+
+
+# Lower bound for the number of HTTP connections each client keeps open
+MIN_POOL_CONNECTIONS = 10
+
+# Total number of attempts per API request, including the first one
+MAX_ATTEMPTS = 8
+
+# Error codes that mean a profile's credentials are no good, as opposed to
+# something that might not happen next time
+AUTH_ERROR_CODES = ("AuthFailure",
+                    "UnauthorizedOperation",
+                    "InvalidClientTokenId",
+                    "SignatureDoesNotMatch")
+
+
+# *** CLASSES ***
+class SessionPool(object):
+    """Hands out one botocore session per AWS profile and one EC2 client per
+    (profile, region), creating them on first use.
+
+    Sessions aren't thread-safe, so everything they're used for is
+    serialised.  Clients can then be shared freely between threads."""
+
+    def __init__(self, max_connections=MIN_POOL_CONNECTIONS, stats=None, limiter=None):
+        """@param stats, if given, is a stats.ApiStats object that will be
+        told about every request made using the pool.
+        @param limiter, if given, is a ratelimit.RateLimiter that every
+        request made using the pool has to go through."""
+        self.lock = threading.RLock()
+        self.stats = stats
+        self.limiter = limiter
+        self.sessions = {}
+        self.clients = {}
+        # profile -> None if the credentials are OK, otherwise the exception
+        # raised when they were found to be bad
+        self.validated = {}
+        self.config = botocore.config.Config(
+                        max_pool_connections=max(max_connections, MIN_POOL_CONNECTIONS),
+                        tcp_keepalive=True,
+                        retries={'mode': 'adaptive', 'max_attempts': MAX_ATTEMPTS})
+
+
+    def session(self, profile):
+        with self.lock:
+            if profile not in self.sessions:
+                session = botocore.session.Session(profile=profile or None)
+                models.use_bundled_models(session)
+                events = session.get_component('event_emitter')
+                if self.stats:
+                    self.stats.register(events, profile)
+                if self.limiter:
+                    self.limiter.register(events, profile)
+                self.sessions[profile] = session
+            return self.sessions[profile]
+
+
+    def collect_stats(self, stats):
+        """Tells stats (a stats.ApiStats object) about every request made
+        using the pool from now on, including by existing clients."""
+        with self.lock:
+            self.stats = stats
+            for profile, session in self.sessions.items():
+                stats.register(session.get_component('event_emitter'), profile)
+            # Clients copy their session's event handlers when created
+            for (profile, region), client in self.clients.items():
+                stats.register(client.meta.events, profile)
+
+
+    def client(self, profile, region):
+        with self.lock:
+            key = (profile, region)
+            if key not in self.clients:
+                self.clients[key] = self.session(profile).create_client("ec2", region_name=region,
+                                                                        config=self.config)
+            return self.clients[key]
+
+
+    def validate(self, profile, region):
+        """Checks that the credentials for a profile work, using a dry-run API
+        request in the given region.  Once a profile's credentials have been
+        found to work (or to be bad), the outcome is reused; other failures,
+        like connection errors, aren't remembered so the next call tries
+        again."""
+
+        with self.lock:
+            if profile not in self.validated:
+                try:
+                    self.client(profile, region).describe_instances(DryRun=True, MaxResults=5)
+                    self.validated[profile] = None
+                except botocore.exceptions.EndpointConnectionError as e:
+                    raise errors.NetworkError("timeout or connection error")
+                except botocore.exceptions.ClientError as e:
+                    code = e.response['Error']['Code']
+                    if code == "DryRunOperation":
+                        # Would have succeeded
+                        self.validated[profile] = None
+                    elif code in AUTH_ERROR_CODES:
+                        self.validated[profile] = errors.AuthError("Permission denied")
+                    else:
+                        raise errors.AuthError("Permission denied")
+                except botocore.exceptions.NoCredentialsError:
+                    self.validated[profile] = errors.AuthError("No credentials")
+
+            if self.validated[profile]:
+                raise self.validated[profile]
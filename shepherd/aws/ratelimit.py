@@ -0,0 +1,153 @@
+"""Client-side rate limiting of EC2 API requests, shared by every cohort in
+the process.  EC2 limits requests per account and region using token buckets,
+with a different bucket for requests that change things, so there's a
+matching bucket here for each (profile, region, kind) and every request waits
+for a token before it's sent.  When EC2 throttles a request anyway (e.g.
+because something else is using the same account), the bucket's rate is cut,
+then recovers gradually."""
+
+
+import threading
+import time
+
+from .stats import THROTTLING_ERROR_CODES
+
+
+# Requests per second and burst size (in seconds' worth of requests) for each
+# kind of request, roughly as documented for EC2
+DEFAULT_RATES = {'describe': 20.0,
+                 'mutate':   5.0}
+BURST_SECONDS = {'describe': 5,
+                 'mutate':   40}
+
+# Operations whose names start with these don't change anything
+DESCRIBE_PREFIXES = ('Describe', 'Get', 'List')
+
+# How much the rate is cut each time a request is throttled, the lowest it
+# can go (as a fraction of the configured rate), and how quickly it recovers
+# (fraction of the configured rate regained per second)
+BACKOFF_FACTOR = 0.5
+MIN_RATE_FRACTION = 0.05
+RECOVERY_PER_SECOND = 0.05
+
+
+# *** CLASSES ***
+class TokenBucket(object):
+    """Hands out tokens at up to rate per second, allowing bursts of up to
+    capacity.  Safe to share between threads; callers that have to wait
+    reserve their token first, so they're served in order."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = clock()
+
+
+    def set_rate(self, rate, capacity):
+        with self.lock:
+            self.refill(self.clock())
+            self.max_rate = rate
+            self.rate = min(self.rate, rate)
+            self.capacity = capacity
+            self.tokens = min(self.tokens, capacity)
+
+
+    def refill(self, now):
+        # Must be called with the lock held
+        elapsed = max(now - self.updated, 0.0)
+        self.updated = now
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.rate = min(self.max_rate, self.rate + elapsed * self.max_rate * RECOVERY_PER_SECOND)
+
+
+    def acquire(self):
+        """Takes a token, waiting until one is available.  Returns the number
+        of seconds waited."""
+        with self.lock:
+            self.refill(self.clock())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            wait = -self.tokens / self.rate
+        self.sleep(wait)
+        return wait
+
+
+    def throttled(self):
+        """Slows down, after a request was rejected for being too fast."""
+        with self.lock:
+            self.refill(self.clock())
+            self.rate = max(self.rate * BACKOFF_FACTOR, self.max_rate * MIN_RATE_FRACTION)
+            self.tokens = min(self.tokens, 0)
+
+
+
+class RateLimiter(object):
+    """Keeps a TokenBucket for each (profile, region, kind of request), and
+    makes every EC2 client created from a registered session use them."""
+
+    def __init__(self, rates=None, clock=time.monotonic, sleep=time.sleep):
+        """@param rates maps each kind of request ('describe' or 'mutate') to
+        requests per second; 0 means unlimited."""
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.rates = dict(DEFAULT_RATES)
+        self.buckets = {}
+        if rates:
+            self.set_rates(rates)
+
+
+    def set_rates(self, rates):
+        with self.lock:
+            self.rates.update(rates)
+            for (profile, region, kind), bucket in self.buckets.items():
+                if self.rates[kind]:
+                    bucket.set_rate(self.rates[kind], self.capacity(kind))
+
+
+    def capacity(self, kind):
+        return max(self.rates[kind] * BURST_SECONDS[kind], 1)
+
+
+    def bucket(self, profile, region, operation):
+        """Returns the bucket for the operation, or None if that kind of
+        request isn't limited."""
+        kind = 'describe' if operation.startswith(DESCRIBE_PREFIXES) else 'mutate'
+        with self.lock:
+            if not self.rates[kind]:
+                return None
+            key = (profile, region, kind)
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(self.rates[kind], self.capacity(kind),
+                                                self.clock, self.sleep)
+            return self.buckets[key]
+
+
+    def register(self, events, profile):
+        """Limits requests made by every EC2 client subsequently created from
+        the session for the given profile, given its event system."""
+
+        def before_call(model, context, **kwargs):
+            bucket = self.bucket(profile, context.get('client_region'), model.name)
+            if bucket:
+                bucket.acquire()
+
+        def needs_retry(response, operation, request_dict, **kwargs):
+            # botocore backs off and retries the request itself; this just
+            # slows down everything else going to the same place
+            if response is not None and response[1].get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+                region = request_dict.get('context', {}).get('client_region')
+                bucket = self.bucket(profile, region, operation.name)
+                if bucket:
+                    bucket.throttled()
+
+        # First, so that nothing else sees a request before it's allowed
+        events.register_first('before-call.ec2', before_call,
+                              unique_id='shepherd-rate-limit-before-call')
+        events.register('needs-retry.ec2', needs_retry, unique_id='shepherd-rate-limit-needs-retry')
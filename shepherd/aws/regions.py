@@ -0,0 +1,47 @@
+"""The EC2 regions that hosts can be in.  Getting the list from botocore
+means loading its endpoint data and the EC2 service model, so a snapshot is
+kept here instead.  If a host is in a region that isn't listed (e.g. a new
+one), the list is refreshed from botocore and kept in the on-disk cache."""
+
+
+import threading
+
+from ..utils import cache
+
+
+CACHE_NAME = "aws-regions.json"
+
+# botocore's list for the "aws" partition when this was last updated
+SNAPSHOT = ('af-south-1', 'ap-east-1', 'ap-east-2', 'ap-northeast-1', 'ap-northeast-2',
+            'ap-northeast-3', 'ap-south-1', 'ap-south-2', 'ap-southeast-1', 'ap-southeast-2',
+            'ap-southeast-3', 'ap-southeast-4', 'ap-southeast-5', 'ap-southeast-6',
+            'ap-southeast-7', 'ca-central-1', 'ca-west-1', 'eu-central-1', 'eu-central-2',
+            'eu-north-1', 'eu-south-1', 'eu-south-2', 'eu-west-1', 'eu-west-2', 'eu-west-3',
+            'il-central-1', 'me-central-1', 'me-south-1', 'mx-central-1', 'sa-east-1',
+            'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2')
+
+
+# *** CLASSES ***
+class RegionList(object):
+    """The snapshot plus whatever was in the cache.  Safe to share between
+    threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.regions = set(SNAPSHOT)
+        cached = cache.load(CACHE_NAME)
+        if isinstance(cached, list):
+            self.regions.update(cached)
+        self.refreshed = False
+
+
+    def check(self, region, session):
+        """Returns whether the region exists.  If it isn't known, the list is
+        refreshed from botocore (using the given botocore session) first, but
+        only once per process."""
+        with self.lock:
+            if region not in self.regions and not self.refreshed:
+                self.regions.update(session.get_available_regions("ec2"))
+                self.refreshed = True
+                cache.save(CACHE_NAME, sorted(self.regions))
+            return region in self.regions
@@ -0,0 +1,164 @@
+"""Counts and times every EC2 API request, using hooks on the botocore session's
+event system, so that it's possible to see which paths are expensive."""
+
+
+import functools
+import threading
+import time
+
+
+# Error codes that mean a request was throttled
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException', 'ThrottledException',
+                          'RequestThrottled', 'RequestThrottledException',
+                          'RequestLimitExceeded', 'TooManyRequestsException',
+                          'EC2ThrottledException')
+
+# Keys in the request context for the time that the request was started, the
+# name of the operation and the profile whose session made it
+START_TIME_KEY = 'shepherd_start_time'
+OPERATION_KEY = 'shepherd_operation'
+PROFILE_KEY = 'shepherd_profile'
+
+
+# *** CLASSES ***
+class OperationStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0         # requests that ultimately failed
+        self.retries = 0
+        self.throttles = 0      # attempts rejected because of throttling
+        self.seconds = 0.0      # total time, including retries
+        self.max_seconds = 0.0
+
+
+    def add(self, other):
+        self.calls += other.calls
+        self.errors += other.errors
+        self.retries += other.retries
+        self.throttles += other.throttles
+        self.seconds += other.seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+
+
+    def as_dict(self):
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'retries': self.retries,
+                'throttles': self.throttles,
+                'seconds': round(self.seconds, 3),
+                'max_seconds': round(self.max_seconds, 3)}
+
+
+
+class ApiStats(object):
+    """Statistics for each operation in each region of each account
+    (profile).  Safe to share between threads."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.operations = {}    # (profile, region, operation name) -> OperationStats
+
+
+    def register(self, events, profile):
+        """Starts collecting statistics for requests made by every EC2 client
+        subsequently created from the session for the given profile, given
+        its event system."""
+        events.register('before-parameter-build.ec2', functools.partial(self.before_call, profile),
+                        unique_id='shepherd-stats-before-call')
+        events.register('after-call.ec2', self.after_call, unique_id='shepherd-stats-after-call')
+        events.register('after-call-error.ec2', self.after_call_error,
+                        unique_id='shepherd-stats-after-call-error')
+        events.register('needs-retry.ec2', self.needs_retry, unique_id='shepherd-stats-needs-retry')
+
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+
+    def get(self, profile, region, operation):
+        # Must be called with the lock held
+        key = (profile, region, operation)
+        if key not in self.operations:
+            self.operations[key] = OperationStats()
+        return self.operations[key]
+
+
+    def before_call(self, profile, model, context, **kwargs):
+        # This is the first event for a request, so the time includes
+        # building the request as well as sending it
+        context[START_TIME_KEY] = self.clock()
+        context[OPERATION_KEY] = model.name
+        context[PROFILE_KEY] = profile
+
+
+    def after_call(self, http_response, parsed, model, context, **kwargs):
+        # A dry run "fails" if it would have succeeded
+        failed = http_response.status_code >= 300 and \
+                 parsed.get('Error', {}).get('Code') != 'DryRunOperation'
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        self.record(context, model.name, failed, retries)
+
+
+    def after_call_error(self, context, **kwargs):
+        # An exception was raised by the HTTP layer, e.g. a connection
+        # error; after-call isn't emitted in this case
+        self.record(context, context.get(OPERATION_KEY), True, 0)
+
+
+    def needs_retry(self, response, operation, request_dict, **kwargs):
+        # Called after every attempt, so just look for throttling errors
+        if response is not None:
+            code = response[1].get('Error', {}).get('Code')
+            if code in THROTTLING_ERROR_CODES:
+                context = request_dict.get('context', {})
+                with self.lock:
+                    self.get(context.get(PROFILE_KEY), context.get('client_region'),
+                             operation.name).throttles += 1
+
+
+    def record(self, context, operation, failed, retries):
+        start = context.get(START_TIME_KEY)
+        elapsed = self.clock() - start if start is not None else 0.0
+        with self.lock:
+            stats = self.get(context.get(PROFILE_KEY), context.get('client_region'), operation)
+            stats.calls += 1
+            stats.retries += retries
+            stats.seconds += elapsed
+            stats.max_seconds = max(stats.max_seconds, elapsed)
+            if failed:
+                stats.errors += 1
+
+
+    def totals(self):
+        total = OperationStats()
+        with self.lock:
+            for stats in self.operations.values():
+                total.add(stats)
+        return total
+
+
+    def as_dict(self):
+        with self.lock:
+            operations = [dict(stats.as_dict(), profile=profile or "default", region=region,
+                               operation=operation)
+                          for (profile, region, operation), stats in
+                              sorted(self.operations.items(),
+                                     key=lambda item: tuple(str(part) for part in item[0]))]
+        return {'operations': operations, 'total': self.totals().as_dict()}
+
+
+    def show(self, dest):
+        """Writes a table of the statistics to dest."""
+        line_format = "%-12s %-16s %-24s %6s %6s %7s %9s %9s %7s"
+        print(line_format % ("Profile", "Region", "Operation", "Calls", "Errors", "Retries",
+                             "Throttles", "Seconds", "Max"), file=dest)
+        data = self.as_dict()
+        for entry in data['operations'] + [dict(data['total'], profile="Total", region="",
+                                                operation="")]:
+            print(line_format % (entry['profile'], entry['region'], entry['operation'],
+                                 entry['calls'], entry['errors'], entry['retries'],
+                                 entry['throttles'],
+                                 "%.3f" % entry['seconds'], "%.3f" % entry['max_seconds']),
+                  file=dest)
@@ -0,0 +1,240 @@
+"""Runs many commands in one process, so that everything that's slow to set up
+(importing Ansible and botocore, loading the inventory, creating sessions
+and clients, checking credentials) is only done once.  Commands come from a
+file (--batch) or from clients of a Unix socket (serve), and each one gets a
+JSON result:
+
+  {"command": [args...], "exit_code": 0, "seconds": 1.234,
+   "records": [...], "output": "...", "messages": "..."}
+
+where records are the host records that would have been shown as a table,
+output is anything else written to stdout (e.g. with -o json) and messages is
+everything written to stderr.
+
+Each command line has the same syntax as shepherd's own (minus the program
+name), and any options given before --batch or serve are put in front of it.
+A line can also be a JSON array of arguments.  Blank lines and comments are
+ignored.  The inventory is checked for changes before every command and
+reloaded if necessary."""
+
+
+import sys
+import os
+import io
+import json
+import time
+import shlex
+import logging
+import threading
+import contextlib
+
+from .utils import messages
+from .utils import cache
+
+
+# Options that start batch mode or the server, so they aren't passed on to
+# each command
+BATCH_OPTIONS = ('--batch', '--socket')
+
+SOCKET_NAME = "shepherd.sock"
+
+
+# *** CLASSES ***
+class CommandRunner(object):
+    """Runs commands one at a time (they share the providers' state), with
+    their output captured."""
+
+    def __init__(self, base_args):
+        self.base_args = base_args
+        self.lock = threading.Lock()
+
+
+    def run_line(self, line):
+        """Returns the result of the command on a line, or None if the line
+        doesn't have one."""
+        line = line.strip()
+        if not line or line.startswith('#'):
+            return None
+
+        try:
+            if line.startswith('['):
+                args = json.loads(line)
+                if not isinstance(args, list) or not all(isinstance(arg, str) for arg in args):
+                    raise ValueError("not a list of strings")
+            else:
+                args = shlex.split(line, comments=True)
+        except ValueError as e:
+            return {'command': line, 'exit_code': 1, 'seconds': 0.0, 'records': [],
+                    'output': "", 'messages': "%s: Error: Can't parse command: %s\n" % (messages.self, e)}
+        return self.run(args)
+
+
+    def run(self, args):
+        from . import run as run_command
+
+        records = []
+        output = io.StringIO()
+        errors = io.StringIO()
+        # Log messages are part of the command's messages, too
+        handler = logging.StreamHandler(errors)
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        logger = logging.getLogger("shepherd")
+
+        with self.lock:
+            propagate = logger.propagate
+            logger.addHandler(handler)
+            logger.propagate = False
+            start = time.monotonic()
+            try:
+                with contextlib.redirect_stdout(output), contextlib.redirect_stderr(errors):
+                    try:
+                        exit_code = run_command(self.base_args + args, records) or 0
+                    except SystemExit as e:
+                        # e.g. from --help, or an unknown option
+                        if e.code is None or isinstance(e.code, int):
+                            exit_code = e.code or 0
+                        else:
+                            messages.report_error(str(e.code))
+                            exit_code = 1
+                    except Exception as e:
+                        messages.report_error("%s: %s" % (type(e).__name__, e))
+                        exit_code = 1
+            finally:
+                logger.removeHandler(handler)
+                logger.propagate = propagate
+
+        return {'command': args,
+                'exit_code': exit_code,
+                'seconds': round(time.monotonic() - start, 3),
+                'records': records,
+                'output': output.getvalue(),
+                'messages': errors.getvalue()}
+
+
+
+def make_request_handler():
+    import socketserver
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        """Runs each line sent by a client and sends back its result, as one
+        line of JSON."""
+
+        def handle(self):
+            for line in iter(self.rfile.readline, b''):
+                result = self.server.runner.run_line(line.decode('utf-8', 'replace'))
+                if result is not None:
+                    self.wfile.write((json.dumps(result) + "\n").encode('utf-8'))
+                    self.wfile.flush()
+
+    return RequestHandler
+
+
+
+# *** FUNCTIONS ***
+def base_args(all_args):
+    """Returns the command-line arguments minus the ones that start batch mode
+    or the server, to be put in front of each command's arguments."""
+    args = []
+    skip = False
+    for n, arg in enumerate(all_args):
+        if skip:
+            skip = False
+        elif arg in BATCH_OPTIONS:
+            skip = True
+        elif arg.startswith(tuple(option + "=" for option in BATCH_OPTIONS)):
+            pass
+        elif arg == 'serve' and n == len(all_args) - 1:
+            pass
+        else:
+            args.append(arg)
+    return args
+
+
+def default_socket_path():
+    return os.path.join(os.getenv('XDG_RUNTIME_DIR') or cache.cache_dir(), SOCKET_NAME)
+
+
+def run_batch(filename, base_args):
+    """Runs each command in the file (or stdin if filename is "-") and writes
+    its result to stdout as soon as it's finished.  Returns the exit code of
+    the first command that failed, or 0."""
+
+    runner = CommandRunner(base_args)
+    first_failure = 0
+    try:
+        if filename == '-':
+            stream = sys.stdin
+        else:
+            stream = open(filename)
+    except OSError as e:
+        messages.report_error("Can't read commands: " + str(e))
+        return 7
+
+    try:
+        # Not "for line in stream", which could wait for more input before
+        # running a command that's already been received
+        for line in iter(stream.readline, ''):
+            result = runner.run_line(line)
+            if result is not None:
+                print(json.dumps(result))
+                sys.stdout.flush()
+                if result['exit_code'] and not first_failure:
+                    first_failure = result['exit_code']
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+    return first_failure
+
+
+def serve(socket_path, base_args):
+    """Runs commands sent by clients of a Unix socket (one per line), until
+    interrupted.  Clients can be served concurrently but their commands are
+    run one at a time."""
+    import socket
+    import socketserver
+
+    if os.path.exists(socket_path):
+        # Don't take over from another server, but clean up after one that
+        # has gone away
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            messages.report_error("Already serving on " + socket_path)
+            return 1
+        except OSError:
+            os.unlink(socket_path)
+        finally:
+            probe.close()
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    try:
+        os.makedirs(os.path.dirname(socket_path), mode=0o700, exist_ok=True)
+        # Only the user can connect, since commands can terminate instances;
+        # the umask only applies to the socket, not the directories above
+        old_umask = os.umask(0o177)
+        try:
+            server = Server(socket_path, make_request_handler())
+        finally:
+            os.umask(old_umask)
+    except OSError as e:
+        messages.report_error("Can't listen on %s: %s" % (socket_path, e))
+        return 1
+
+    server.runner = CommandRunner(base_args)
+    messages.report_info("Listening on " + socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            os.unlink(socket_path)
+        except OSError:
+            pass
+    return 0
@@ -8,16 +8,21 @@ import re
 from .utils.cmdline_controller import Handler as Handler
 from . import __doc__ as program_docstring
 from . import errors
+from . import inventory
+from .formatting import formats, SORT_KEYS
 
 
-basic_options='hdi:ynws:m:RSvq'
-basic_long_options=['help', 'inventory-file=', 'confirm', 'dry-run', 'quiet',
-                    'poll', 'interval=', 'max-poll=',
-                    'running', 'stopped']
+basic_options='hdi:ynws:m:o:RSvq'
+basic_long_options=['help', 'inventory-file=', 'no-inventory-cache', 'inventory-ttl=', 'confirm', 'dry-run', 'quiet',
+                    'poll', 'interval=', 'max-poll=', 'timeout=',
+                    'running', 'stopped', 'parallel=', 'no-ptr', 'ptr-ttl=',
+                    'chunk-size=', 'state-ttl=', 'fresh', 'format=', 'sort=',
+                    'engine=', 'stats', 'stats-file=', 'batch=', 'socket=',
+                    'batch-size=', 'batch-percent=', 'pause=']
 
 # -- action stuff --
 # roughly mimic the commands supported by service(8)
-allowed_actions = ('status', 'fullstatus', 'start', 'restart', 'stop', 'kill')
+allowed_actions = ('status', 'fullstatus', 'start', 'restart', 'stop', 'kill', 'watch')
 
 # translate other action sets into the above
 virsh_actions = {'list': 'status', 'dominfo': 'fullstatus', 'start': 'start', 'reboot': 'restart', 'shutdown': 'stop', 'destroy': 'kill'}
@@ -25,6 +30,9 @@ aws_actions = {'start': 'start', 'reboot': 'restart', 'stop': 'stop', 'terminate
 vagrant_actions = {'up': 'start', 'reload': 'restart', 'halt': 'stop', 'destroy': 'kill'}
 other_actions = {'delete': 'kill', 'show': 'fullstatus'}
 
+# Ways of running the cohorts: go() and poll() with threads, or shepherd.engine
+engines = ('threads', 'asyncio')
+
 cmdline_handler = None
 
 
@@ -43,15 +51,37 @@ class MyHandler(Handler):
         self.params['verbose'] = 1
         self.params['poll_interval'] = 5
         self.params['max_poll'] = 20
-        self.params['inventory_filename'] = os.getenv('ANSIBLE_INVENTORY',
-                                                      os.getenv('ANSIBLE_HOSTS',
-                                                                "/etc/ansible/hosts"))
+        self.params['parallel'] = 0
+        self.params['chunk_size'] = 100
+        self.params['state_ttl'] = 0
+        self.params['format'] = 'table'
+        self.params['sort'] = None
+        self.params['engine'] = 'threads'
+        # Provider name -> object with the API statistics it collected
+        self.params['api_stats'] = {}
+        self.params['reverse_dns'] = True
+        self.params['ptr_ttl'] = 0
+        # Like Ansible, the environment variable can list several sources
+        self.params['inventory_paths'] = os.getenv('ANSIBLE_INVENTORY',
+                                                   os.getenv('ANSIBLE_HOSTS',
+                                                             "/etc/ansible/hosts")).split(",")
+        self.params['inventory_cache'] = True
+        self.params['inventory_ttl'] = inventory.SCRIPT_TTL
+        self.inventory_given = False
         self.params['logfile'] = None
 
 
     def handle(self, option, opt_arg): 
         if option == "-i" or option == "--inventory-file":
-            self.params['inventory_filename'] = opt_arg
+            # Each one adds a source, replacing the default
+            if not self.inventory_given:
+                self.params['inventory_paths'] = []
+                self.inventory_given = True
+            self.params['inventory_paths'].append(opt_arg)
+        elif option == "--no-inventory-cache":
+            self.params['inventory_cache'] = False
+        elif option == "--inventory-ttl":
+            self.params['inventory_ttl'] = int(opt_arg)
         elif option == "-y" or option == "--confirm":
             self.params['confirm'] = True
         elif option == "-w" or option == "--poll":
@@ -64,8 +94,53 @@ class MyHandler(Handler):
         elif option == "-m" or option == "--max-poll":
             self.params['poll'] = True
             self.params['max_poll'] = int(opt_arg)
+        elif option == "--timeout":
+            self.params['poll'] = True
+            self.params['timeout'] = int(opt_arg)
+        elif option == "--parallel":
+            self.params['parallel'] = int(opt_arg)
+        elif option == "--chunk-size":
+            self.params['chunk_size'] = max(1, int(opt_arg))
+        elif option == "--state-ttl":
+            self.params['state_ttl'] = int(opt_arg)
+        elif option == "--fresh":
+            self.params['fresh'] = True
+        elif option == "--no-ptr":
+            self.params['reverse_dns'] = False
+        elif option == "--ptr-ttl":
+            self.params['ptr_ttl'] = int(opt_arg)
         elif option == "-n" or option == "--dry-run":
             self.params['dry_run'] = True
+        elif option == "-o" or option == "--format":
+            if opt_arg not in formats:
+                raise errors.CommandlineError("Unknown output format '%s'" % opt_arg)
+            self.params['format'] = opt_arg
+        elif option == "--sort":
+            if opt_arg not in SORT_KEYS:
+                raise errors.CommandlineError("Unknown sort order '%s'" % opt_arg)
+            self.params['sort'] = opt_arg
+        elif option == "--engine":
+            if opt_arg not in engines:
+                raise errors.CommandlineError("Unknown engine '%s'" % opt_arg)
+            self.params['engine'] = opt_arg
+        elif option == "--stats":
+            self.params['stats'] = True
+        elif option == "--stats-file":
+            self.params['stats_file'] = opt_arg
+        elif option == "--batch":
+            self.params['batch'] = opt_arg
+        elif option == "--socket":
+            self.params['socket'] = opt_arg
+        elif option == "--batch-size":
+            self.params['wave_size'] = int(opt_arg)
+            if self.params['wave_size'] < 1:
+                raise errors.CommandlineError("Batch size must be at least 1")
+        elif option == "--batch-percent":
+            self.params['wave_percent'] = float(opt_arg)
+            if not 0 < self.params['wave_percent'] <= 100:
+                raise errors.CommandlineError("Batch percentage must be between 0 and 100")
+        elif option == "--pause":
+            self.params['wave_pause'] = float(opt_arg)
         elif option == "-R" or option == "--running":
             self.params['only_running'] = True
         elif option == "-S" or option == "--stopped":
@@ -118,6 +193,10 @@ def process_args(args):
     if args == ['list']:
         action = 'status'
         host_pattern = "all"
+    elif args == ['serve']:
+        # see shepherd.batch
+        action = 'serve'
+        host_pattern = None
     else:
         ## print len(args), '[' + "; ".join(args) + ']'
         if len(args) == 2:
@@ -0,0 +1,294 @@
+"""Alternative to go() and poll() that drives every cohort from a single
+asyncio event loop.  Each region is taken through its whole pipeline (setting
+up the cohort, taking the action, then polling) independently, so a region
+can be polled while others are still acting on their instances.  Blocking
+provider calls run in the loop's executor; see provider.Cohort."""
+
+
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from . import formatting
+from . import polling
+from . import rolling
+from . import errors
+from .utils import messages
+
+
+# Phases that each region goes through, and what's known about its instances
+# while it's in that phase (unless the cohort can say more)
+PHASE_DESCRIPTIONS = {'waiting':    "not started",
+                      'connecting': "not started",
+                      'acting':     "requested, outcome unknown",
+                      'acted':      "requested",
+                      'polling':    "requested, still changing state",
+                      'finished':   "done"}
+
+
+# *** CLASSES ***
+class RegionJob(object):
+    """One region's hosts (for one profile), and how far they've got."""
+
+    def __init__(self, provider, profile, region, host_map):
+        self.provider = provider
+        self.profile = profile
+        self.region = region
+        self.host_map = host_map
+        self.phase = 'waiting'
+        self.cohort = None
+        self.output = None
+        # Set once any table output for the region can be shown
+        self.output_ready = False
+
+
+
+class Engine(object):
+    def __init__(self, action, host_maps, params):
+        self.action = action
+        self.host_maps = host_maps
+        self.params = params
+        self.polling = params['poll'] and action != "status" and not params['dry_run']
+        self.provider_info = {}
+        self.jobs = []
+        self.next_output = 0    # index of the first job whose output hasn't been shown
+        self.poller = None
+        self.undesired_count = 0
+        # Set when a region has failed, so that no more are started
+        self.stopping = False
+
+
+    def run(self):
+        """Takes the action (and polls, if requested) on every region of
+        every provider.  Returns the same provider info as go().  If
+        interrupted, shows what's known about each instance and re-raises
+        KeyboardInterrupt."""
+
+        for provider in self.host_maps:
+            self.provider_info[provider] = {}
+            try:
+                self.provider_info[provider]['module'] = __import__(provider, globals=globals(), level=1)
+                self.provider_info[provider]['module'].init(self.params)
+            except ImportError as e:
+                raise errors.ProviderError("Unknown provider " + provider)
+
+            for profile in self.host_maps[provider]:
+                for region in self.host_maps[provider][profile]:
+                    self.jobs.append(RegionJob(provider, profile, region,
+                                               self.host_maps[provider][profile][region]))
+
+        if self.action == 'kill' and not self.params['confirm']:
+            # Checked before the event loop starts, because SystemExit
+            # raised by a task would escape from it
+            messages.report_notice("Not killing instances because -y wasn't specified")
+            raise SystemExit(0)
+
+        # Each region makes at most one blocking call at a time
+        executor = ThreadPoolExecutor(max_workers=max(len(self.jobs), 1))
+        loop = asyncio.new_event_loop()
+        loop.set_default_executor(executor)
+        asyncio.set_event_loop(loop)
+        main_task = loop.create_task(self.run_all())
+        try:
+            loop.run_until_complete(main_task)
+        except KeyboardInterrupt:
+            main_task.cancel()
+            try:
+                loop.run_until_complete(main_task)
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.report(sys.stderr)
+            raise
+        finally:
+            # Don't wait for requests that are still in progress after an
+            # interruption; their results aren't wanted
+            executor.shutdown(wait=False)
+            asyncio.set_event_loop(None)
+            loop.close()
+
+        return self.provider_info
+
+
+    async def run_all(self):
+        params = self.params
+
+        if params['format'] != 'table' or params['sort']:
+            # Records from every region go through one formatter and messages
+            # go to stderr, as with go()
+            self.formatter = formatting.make_formatter(params['format'], self.action,
+                                                      params.get('records'))
+            self.message_output = sys.stderr
+        else:
+            self.formatter = None
+            self.message_output = None
+
+        if params['sort']:
+            merger = formatting.MergingFormatter(self.formatter, params['sort'])
+            for job in self.jobs:
+                job.source = merger.add_source(job.host_map)
+            self.formatter = merger
+
+        if self.polling:
+            timeout = polling.timeout_for(params)
+            if params['format'] != 'table':
+                poll_output = sys.stderr
+            else:
+                poll_output = sys.stdout
+            self.poller = polling.Poller(self.action, params['poll_interval'], timeout,
+                                         params['verbose'], poll_output)
+
+        # Limits the number of regions taking action at once; polling isn't
+        # limited because it's mostly waiting
+        self.semaphore = asyncio.Semaphore(params['parallel'] or len(self.jobs))
+
+        try:
+            # Create every cohort first, so that a bad region or credentials
+            # stop the run before anything has been done
+            loop = asyncio.get_event_loop()
+            for job in self.jobs:
+                job.output = self.message_output or io.StringIO()
+                job.phase = 'connecting'
+            results = await asyncio.gather(*[loop.run_in_executor(None, self.make_cohort, job)
+                                             for job in self.jobs],
+                                           return_exceptions=True)
+            for job, result in zip(self.jobs, results):
+                if isinstance(result, BaseException):
+                    raise result
+                job.cohort = result
+                job.phase = 'waiting'
+
+            tasks = [asyncio.ensure_future(self.run_job(job)) for job in self.jobs]
+            try:
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            except asyncio.CancelledError:
+                # Interrupted, so nothing that's still going is wanted
+                for task in tasks:
+                    task.cancel()
+                await asyncio.wait(tasks)
+                raise
+
+            if any(task.done() and not task.cancelled() and task.exception() for task in tasks):
+                # Stop the other regions, except for those in the middle of
+                # taking the action, which finish so that their outcomes are
+                # shown (but aren't polled)
+                self.stopping = True
+                for job, task in zip(self.jobs, tasks):
+                    if job.phase != 'acting':
+                        task.cancel()
+                await asyncio.wait(tasks)
+
+            # Raise the exception that a serial run would have raised first, and
+            # report any others
+            errors_raised = [(job, task.exception()) for job, task in zip(self.jobs, tasks)
+                             if not task.cancelled() and task.exception()]
+            for job, e in errors_raised[1:]:
+                messages.report_error("%s (%s): %s" %
+                                      (job.region,
+                                       formatting.describe_provider(job.provider, job.profile), e))
+            if errors_raised:
+                raise errors_raised[0][1]
+        finally:
+            if params['sort']:
+                # Show what was collected from the regions that did take action
+                self.formatter.flush()
+            # Even after an error, so that e.g. a JSON list is terminated
+            if self.formatter:
+                self.formatter.end()
+
+        if self.polling and params['verbose'] >= 2:
+            output = self.poller.output
+            if not any(job.cohort.action_required() for job in self.jobs if job.cohort):
+                print(" No action required.", file=output)
+            elif self.undesired_count == 0:
+                print(" Complete.", file=output)
+            else:
+                print(" Giving up.", file=output)
+
+
+    async def run_job(self, job):
+        """Takes one region through its whole pipeline."""
+        try:
+            async with self.semaphore:
+                if job.cohort:
+                    job.phase = 'acting'
+                    if self.action != "status" and self.action != 'fullstatus' and \
+                       self.params['verbose'] >= 1:
+                        print("Running %s on instances in region %s (%s):\n  " %
+                                (self.action, job.region,
+                                 formatting.describe_provider(job.provider, job.profile)),
+                              ", ".join(job.cohort.instance_ids), file=job.output)
+                    await job.cohort.async_take_action(self.action)
+                    self.provider_info[job.provider][(job.profile, job.region)] = job.cohort
+            job.phase = 'acted'
+        finally:
+            if self.params['sort']:
+                job.source.end()
+            job.output_ready = True
+            self.show_outputs()
+
+        if self.polling and job.cohort and not self.stopping:
+            job.phase = 'polling'
+            self.undesired_count += await self.poller.poll_async(job.cohort)
+        job.phase = 'finished'
+
+
+    def make_cohort(self, job):
+        """Like create_cohort(), and also shows the summary line for status."""
+
+        module = self.provider_info[job.provider]['module']
+        if self.params['sort']:
+            formatter = job.source
+        else:
+            formatter = self.formatter
+
+        if self.action == "status" and self.params['verbose'] >= 1 and not formatter:
+            print(job.region, "(" + formatting.describe_provider(job.provider, job.profile) + ")",
+                  file=job.output)
+
+        if not job.host_map:
+            messages.report_notice("No hosts had correct cloud info")
+            return None
+
+        cohort = rolling.make_cohort(module, self.action, job.region, list(job.host_map),
+                                     job.host_map, self.params, job.profile)
+        cohort.output = job.output
+        if formatter:
+            cohort.formatter = formatter
+        else:
+            cohort.formatter = formatting.make_formatter('table', self.action, job.output)
+        return cohort
+
+
+    def show_outputs(self):
+        """Shows the buffered table output of each region that's ready, in
+        the same order as a serial run would."""
+        if self.message_output:
+            return
+        while self.next_output < len(self.jobs) and self.jobs[self.next_output].output_ready:
+            sys.stdout.write(self.jobs[self.next_output].output.getvalue())
+            sys.stdout.flush()
+            self.next_output += 1
+
+
+    def report(self, dest):
+        """Shows what's known about every instance, after an interruption."""
+        messages.report_notice("Interrupted; status of each instance:")
+        for job in self.jobs:
+            for id, host in job.host_map.items():
+                status = None
+                if job.cohort:
+                    status = job.cohort.instance_status(id)
+                if status is None:
+                    if self.action in ('status', 'fullstatus'):
+                        status = "shown" if job.phase in ('acted', 'finished') else "not shown"
+                    else:
+                        status = PHASE_DESCRIPTIONS[job.phase]
+                formatting.print_host(host.name, id, "%s (%s)" % (status, job.region), dest=dest)
+        dest.flush()
+
+
+
+# *** FUNCTIONS ***
+def run(action, host_maps, params):
+    return Engine(action, host_maps, params).run()
@@ -26,3 +26,7 @@ class ProviderError(RuntimeError):
 
 class NetworkError(RuntimeError):
     pass
+
+
+class RequestError(RuntimeError):
+    pass
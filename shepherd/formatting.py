@@ -1,10 +1,318 @@
 
 
+import sys
+import heapq
+import threading
 
 
-def print_host(name, id, state, msg=None, indent = "  "):
+# Fields of the records produced by cohorts, in the order they're output
+STATUS_FIELDS = ['name', 'id', 'state', 'provider', 'region']
+FULLSTATUS_FIELDS = STATUS_FIELDS + ['groups', 'fqdn', 'instance_type', 'az',
+                                     'public_ip', 'private_ip', 'ipv6',
+                                     'vpc_id', 'vpc_name', 'subnet_id', 'subnet_name',
+                                     'launch_time', 'image_id']
+
+# For the watch action, which shows state transitions
+WATCH_FIELDS = STATUS_FIELDS + ['previous_state', 'time']
+
+formats = ('table', 'json', 'jsonl', 'csv')
+
+# Functions giving the key that records are sorted by, passed the instance ID,
+# the inventory host and the record (which is None when working out the
+# lowest key that a region could still produce)
+SORT_KEYS = {'name':      lambda id, host, record: host.name,
+             'id':        lambda id, host, record: id,
+             'inventory': lambda id, host, record: host.position,
+             'state':     lambda id, host, record: (record['state'], host.name)}
+
+# Sort keys that are known before the instance has been described
+BOUNDED_SORT_KEYS = ('name', 'id', 'inventory')
+
+
+# *** CLASSES ***
+class Formatter(object):
+    """Writes records (dicts with some of the above fields) to dest (default
+    sys.stdout) as soon as they're received.  Safe to share between threads."""
+
+    def __init__(self, fields=STATUS_FIELDS, dest=None):
+        self.fields = fields
+        self.dest = dest
+        self.lock = threading.Lock()
+        self.count = 0
+
+
+    def write(self, record):
+        with self.lock:
+            dest = self.dest or sys.stdout
+            self.write_record(record, dest)
+            self.count += 1
+            dest.flush()
+
+
+    def end(self):
+        """Called once there are no more records."""
+        pass
+
+
+    def write_record(self, record, dest):
+        raise NotImplementedError
+
+
+
+class TableFormatter(Formatter):
+    """The human-readable format: one line per host, followed by details for
+    fullstatus records."""
+
+    def write_record(self, record, dest):
+        if 'instance_type' in record:
+            msg = self.format_details(record)
+        else:
+            msg = None
+        if record.get('previous_state'):
+            state = "%s -> %s (%s)" % (record['previous_state'], record['state'], record['time'])
+        else:
+            state = record['state']
+        print_host(record['name'], record['id'], state, msg, dest=dest)
+
+
+    @staticmethod
+    def format_details(record):
+        # à la knife node show
+        info = dict((k, v) for k, v in record.items() if v is not None)
+
+        if 'vpc_id' in info:
+            info['vpc_info'] = info['vpc_id']
+            if 'vpc_name' in info:
+                info['vpc_info'] += " (%s)" % info['vpc_name']
+            info['vpc_info'] += ", " + info['subnet_id']
+            if 'subnet_name' in info:
+                info['vpc_info'] += " (%s)" % info['subnet_name']
+
+        # Templates have everything starting on column 0, like for the output
+        # (Backslashes avoid leading newline.)
+        # TO-DO: use Jinja2 or something instead
+        if 'fqdn' in info:
+            template = """\
+FQDN: {fqdn}
+"""
+        else:
+            template = ""
+
+        if info.get('groups'):
+            info['group_list'] = ", ".join(info['groups'])
+            template += """\
+Groups:        {group_list}
+"""
+
+        template += """\
+Instance type: {instance_type}
+Location:      {az} (availability zone)
+IP addrs:      """
+
+        # Addresses
+        if 'public_ip' in info:
+            template += "{public_ip} "
+        template += "{private_ip}"
+        if 'ipv6' in info:
+            template += " {ipv6}"
+
+        if 'vpc_info' in info:
+            template += """
+VPC: {vpc_info}"""
+        template += """
+Launch time:   {launch_time} from AMI: {image_id}"""
+
+        return template.format(**info)
+
+
+
+class JsonLinesFormatter(Formatter):
+    """One JSON object per line."""
+
+    def write_record(self, record, dest):
+        import json
+
+        print(json.dumps(self.select(record)), file=dest)
+
+
+    def select(self, record):
+        return dict((field, record.get(field)) for field in self.fields)
+
+
+
+class JsonFormatter(JsonLinesFormatter):
+    """A single JSON array, written an element at a time."""
+
+    def write_record(self, record, dest):
+        import json
+
+        print("[" if self.count == 0 else ",", json.dumps(self.select(record)), file=dest)
+
+
+    def end(self):
+        with self.lock:
+            dest = self.dest or sys.stdout
+            print("[]" if self.count == 0 else "]", file=dest)
+            dest.flush()
+
+
+
+class CsvFormatter(Formatter):
+    """Comma-separated values, with a header line."""
+
+    writer = None
+
+    def write_record(self, record, dest):
+        import csv
+
+        if not self.writer:
+            self.writer = csv.DictWriter(dest, self.fields, extrasaction='ignore')
+            self.writer.writeheader()
+        if isinstance(record.get('groups'), list):
+            record = dict(record, groups=" ".join(record['groups']))
+        self.writer.writerow(record)
+
+
+
+class RecordListFormatter(JsonLinesFormatter):
+    """Appends each record (with just the usual fields) to a list, which is
+    passed instead of dest.  Used to return structured results; see
+    shepherd.batch."""
+
+    def write(self, record):
+        with self.lock:
+            self.dest.append(self.select(record))
+            self.count += 1
+
+
+
+class MergingFormatter(object):
+    """Merges the records from several regions into one sorted stream and
+    passes them on to another formatter.  Each region gets a source that
+    collects and sorts that region's records; once a region is finished, its
+    records are written as soon as no unfinished region could still produce
+    one that sorts before them."""
+
+    def __init__(self, formatter, sort):
+        self.formatter = formatter
+        self.sort = sort
+        self.key = SORT_KEYS[sort]
+        self.lock = threading.Lock()
+        self.unfinished = []
+        self.heap = []          # (key, seq, source) for each finished source
+        self.seq = 0
+
+
+    def add_source(self, host_map):
+        """Returns a formatter for the records of the hosts in host_map.  Its
+        end() method must be called once the region is finished."""
+        with self.lock:
+            source = MergeSource(self, self.seq, host_map)
+            self.seq += 1
+            self.unfinished.append(source)
+            return source
+
+
+    def finish(self, source):
+        with self.lock:
+            self.unfinished.remove(source)
+            if source.records:
+                heapq.heappush(self.heap, (source.records[0][0], source.seq, source))
+            self.drain()
+
+
+    def drain(self):
+        """Writes every record that's now known to be next in order."""
+        if self.unfinished:
+            bounds = [source.bound for source in self.unfinished]
+            if None in bounds:
+                return
+            limit = min(bounds)
+        else:
+            limit = None
+
+        while self.heap and (limit is None or self.heap[0][0] < limit):
+            key, seq, source = self.heap[0]
+            record = source.records[source.next][1]
+            source.next += 1
+            if source.next < len(source.records):
+                heapq.heapreplace(self.heap, (source.records[source.next][0], seq, source))
+            else:
+                heapq.heappop(self.heap)
+                source.records = []
+            self.formatter.write(record)
+
+
+    def flush(self):
+        """Ends any sources that haven't been ended (e.g. because their region
+        failed or was never started), so that every record collected so far
+        is written."""
+        for source in list(self.unfinished):
+            source.end()
+
+
+    def end(self):
+        self.formatter.end()
+
+
+
+class MergeSource(object):
+    """The per-region side of a MergingFormatter."""
+
+    def __init__(self, merger, seq, host_map):
+        self.merger = merger
+        self.seq = seq
+        self.host_map = host_map
+        self.records = []       # (key, record)
+        self.next = 0
+        # The lowest key this region could produce, or None if unknown
+        if merger.sort in BOUNDED_SORT_KEYS and host_map:
+            self.bound = min(merger.key(id, host, None) for id, host in host_map.items())
+        else:
+            self.bound = None
+
+
+    def write(self, record):
+        key = self.merger.key(record['id'], self.host_map[record['id']], record)
+        self.records.append((key, record))
+
+
+    def end(self):
+        self.records.sort(key=lambda item: item[0])
+        self.merger.finish(self)
+
+
+
+# *** FUNCTIONS ***
+def make_formatter(format, action, dest=None):
+    """Returns a formatter for the given output format (one of 'formats', or
+    'records' with a list as dest) with fields suitable for the action."""
+    if action == 'fullstatus':
+        fields = FULLSTATUS_FIELDS
+    elif action == 'watch':
+        fields = WATCH_FIELDS
+    else:
+        fields = STATUS_FIELDS
+    classes = {'table': TableFormatter,
+               'json':  JsonFormatter,
+               'jsonl': JsonLinesFormatter,
+               'csv':   CsvFormatter,
+               'records': RecordListFormatter}
+    return classes[format](fields, dest)
+
+
+def describe_provider(provider, profile):
+    """Returns e.g. "aws" or "aws, profile prod", for summary lines."""
+    if profile is None:
+        return provider
+    return "%s, profile %s" % (provider, profile)
+
+
+def print_host(name, id, state, msg=None, indent = "  ", dest=None):
     """msg, if present, is printed (with a two-space indent) after the normal
-    line."""
-    print("%-24s %-25s %s" % (name, id, state))
+    line.  dest defaults to the current sys.stdout."""
+    if dest is None:
+        dest = sys.stdout
+    print("%-24s %-25s %s" % (name, id, state), file=dest)
     if msg:
-        print(indent + ("\n" + indent).join(msg.split("\n")))
+        print(indent + ("\n" + indent).join(msg.split("\n")), file=dest)
@@ -3,20 +3,49 @@
 
 
 import os.path
+import re
+import gc
+import time
 
 import logging
 
+from .utils import cache
 
-# If we can't seem to find the ansible package, fail with a specific exit code to
-# let bin/shepherd know
-try:
-    from ansible.parsing.dataloader import DataLoader
-except ImportError as e:
-    logging.warning(str(e))
-    raise SystemExit(98)
-## from ansible.inventory.data import InventoryData
-from ansible.inventory.manager import InventoryManager
-import ansible.errors
+# NOTE: Ansible takes a long time to import, so that's only done by parse()
+
+
+# Bump this whenever the format of cached inventories changes
+CACHE_VERSION = 4
+
+# How long the output of an inventory script is reused for, by default
+SCRIPT_TTL = 300
+
+# How Ansible splits a host pattern without commas: at colons that aren't
+# inside a [...] expression
+PATTERN_TERM_RE = re.compile(r'(?:[^\s:\[\]]|\[[^\]]*\])+')
+
+# A pattern term with a subscript, e.g. "web[0]" or "web[2:5]", as Ansible
+# defines it
+SUBSCRIPT_RE = re.compile(r'^(.+)\[(?:(-?[0-9]+)|([0-9]+)([:-])([0-9]*))\]$')
+
+# Characters that make Ansible check a term against host names even if it
+# matched some group names
+HOST_PATTERN_CHARS = ('.', '?', '*', '[')
+
+# Names that Ansible adds to the inventory implicitly if they're used
+LOCALHOST_NAMES = ('127.0.0.1', 'localhost', '::1')
+
+# Groups that every host is in, which aren't worth listing
+IMPLICIT_GROUPS = ('all', 'ungrouped')
+
+# Entries in an inventory directory that Ansible skips (with its default
+# configuration): hidden files, vars directories and backup/editor files
+IGNORED_NAMES_RE = re.compile(r'^\.|^host_vars$|^group_vars$|^vars_plugins$|'
+                              r'(\.pyc|\.pyo|\.swp|\.bak|~|\.rpm|\.md|\.txt|\.rst|\.orig|\.cfg|\.retry)$')
+
+# Absolute inventory path -> InventoryCache, for processes that collate more
+# than once (see shepherd.batch); checked against the signature every time
+loaded_caches = {}
 
 
 # *** CLASSES ***
@@ -32,41 +61,561 @@ class NoHostsError(RuntimeError):
     pass
 
 
+class HostRecord(object):
+    """What collate() stores for each host: just the things shepherd needs,
+    rather than an Ansible Host object that keeps the whole inventory alive.
+    provider, region, instance_id and profile are None if the host doesn't
+    have the corresponding cloud_* variable.  groups is a list of the names of the
+    host's groups, or None if they weren't asked for.  position is the
+    host's index in the list of hosts matching the pattern, i.e. inventory
+    order."""
+
+    __slots__ = ('name', 'provider', 'region', 'instance_id', 'profile', 'groups', 'position')
+
+    def __init__(self, name, provider, region, instance_id, profile=None, groups=None,
+                 position=None):
+        self.name = name
+        self.provider = provider
+        self.region = region
+        self.instance_id = instance_id
+        self.profile = profile
+        self.groups = groups
+        self.position = position
+
+
+    @classmethod
+    def from_ansible(cls, host, with_groups=False):
+        if with_groups:
+            groups = [group.name for group in host.get_groups()
+                      if group.name not in IMPLICIT_GROUPS]
+        else:
+            groups = None
+        return cls(host.name,
+                   host.vars.get('cloud_provider'),
+                   host.vars.get('cloud_region'),
+                   host.vars.get('cloud_instance_id'),
+                   host.vars.get('cloud_profile'),
+                   groups)
+
+
+    def __repr__(self):
+        return "HostRecord(%r, %r, %r, %r)" % (self.name, self.provider, self.region, self.instance_id)
+
+
+
+class InventorySource(object):
+    """A part of the inventory that's parsed and cached separately: either
+    static, i.e. a file or the static files in a directory, which is cached
+    until it (or its vars) change, or dynamic, i.e. an executable inventory
+    script, whose output is only reused for a limited time."""
+
+    def __init__(self, path, paths=None, dynamic=False):
+        """@param path names the cache entry.
+        @param paths lists what Ansible is given, if that isn't just path."""
+        self.path = path
+        self.paths = paths or path
+        self.dynamic = dynamic
+
+
+    def __repr__(self):
+        return "InventorySource(%r, dynamic=%r)" % (self.path, self.dynamic)
+
+
+
+class InventoryCache(object):
+    """The parts of a parsed inventory that shepherd needs: every host (in
+    inventory order) with its cloud info, plus the membership of each group.
+    Stored on disk and reused until the inventory or its vars change."""
+
+    def __init__(self, inventory_filename, signature, hosts, groups, children=None,
+                 created=None):
+        """@param hosts is a list of [name, provider, region, instance ID,
+        profile], where all but the name may be None.
+        @param groups maps each group name to a list of indexes into hosts.
+        @param children maps the name of each group that has child groups
+        to a list of their names.
+        @param created is when the inventory was parsed (as a Unix time)."""
+        self.inventory_filename = inventory_filename
+        self.signature = signature
+        self.hosts = hosts
+        self.groups = groups
+        self.children = children or {}
+        self.created = created or time.time()
+        self.host_indexes = {entry[0]: n for n, entry in enumerate(hosts)}
+        self.host_groups = None     # see groups_of()
+
+
+    @classmethod
+    def from_manager(cls, inventory_filename, signature, manager):
+        # Hosts are kept in the order that Ansible matches host patterns
+        # against them
+        hosts = []
+        host_indexes = {}
+        for host in manager.hosts.values():
+            host_indexes[host.name] = len(hosts)
+            hosts.append([host.name,
+                          host.vars.get('cloud_provider'),
+                          host.vars.get('cloud_region'),
+                          host.vars.get('cloud_instance_id'),
+                          host.vars.get('cloud_profile')])
+
+        groups = {}
+        children = {}
+        for name, group in manager.groups.items():
+            groups[name] = [host_indexes[host.name] for host in group.get_hosts()
+                            if host.name in host_indexes]
+            if group.child_groups:
+                children[name] = [child.name for child in group.child_groups]
+
+        return cls(inventory_filename, signature, hosts, groups, children)
+
+
+    @classmethod
+    def load(cls, inventory_filename, signature, max_age=None):
+        """Returns the cached inventory, or None if there isn't one, it's
+        out of date or it's more than max_age seconds old (if given)."""
+        cached = loaded_caches.get(os.path.abspath(inventory_filename))
+        if not (cached and cached.signature == signature):
+            data = cache.load(cache_name(inventory_filename))
+            try:
+                if data['version'] != CACHE_VERSION or data['signature'] != signature:
+                    return None
+                cached = cls(inventory_filename, signature, data['hosts'], data['groups'],
+                             data['children'], data['created'])
+            except (KeyError, TypeError):
+                return None
+            loaded_caches[os.path.abspath(inventory_filename)] = cached
+
+        if max_age is not None and time.time() - cached.created >= max_age:
+            return None
+        return cached
+
+
+    @classmethod
+    def merge(cls, caches):
+        """Returns an InventoryCache (that isn't saved) for the inventory
+        made up of several sources, combined in the same way as Ansible does
+        when given more than one: hosts are in the order that they first
+        appear, a host's cloud info comes from the last source that has it,
+        and groups have the hosts from every source (including those in child
+        groups from other sources)."""
+        if len(caches) == 1:
+            return caches[0]
+
+        hosts = []
+        host_indexes = {}
+        own_hosts = {}      # group name -> hosts that aren't in its children
+        children = {}
+        for cached in caches:
+            indexes = []        # this source's host indexes -> merged ones
+            for entry in cached.hosts:
+                n = host_indexes.get(entry[0])
+                if n is None:
+                    n = host_indexes[entry[0]] = len(hosts)
+                    hosts.append(list(entry))
+                else:
+                    hosts[n] = [old if new is None else new for old, new in zip(hosts[n], entry)]
+                indexes.append(n)
+            for name, members in cached.groups.items():
+                if name in cached.children:
+                    in_children = set(n for child in descendants(name, cached.children)
+                                      for n in cached.groups.get(child, []))
+                    members = [n for n in members if n not in in_children]
+                own_hosts.setdefault(name, []).extend(indexes[n] for n in members)
+            for name, names in cached.children.items():
+                children.setdefault(name, []).extend(names)
+
+        # Groups are only children of "all" if they have no other parent
+        if 'all' in children:
+            parented = set(child for name, names in children.items() if name != 'all'
+                           for child in names)
+            children['all'] = [child for child in children['all'] if child not in parented]
+
+        # Like Ansible, a group's hosts are its own followed by those of its
+        # children, their children and so on
+        groups = {}
+        for name in own_hosts:
+            groups[name] = []
+            seen = set()
+            for group in [name] + descendants(name, children):
+                for n in own_hosts.get(group, []):
+                    if n not in seen:
+                        seen.add(n)
+                        groups[name].append(n)
+
+        # Hosts in a group in any source aren't ungrouped
+        if 'ungrouped' in groups:
+            grouped = set(n for name, members in groups.items()
+                          if name not in IMPLICIT_GROUPS for n in members)
+            groups['ungrouped'] = [n for n in groups['ungrouped'] if n not in grouped]
+
+        return cls(None, None, hosts, groups, children)
+
+
+    def save(self):
+        loaded_caches[os.path.abspath(self.inventory_filename)] = self
+        cache.save(cache_name(self.inventory_filename),
+                   {'version': CACHE_VERSION,
+                    'signature': self.signature,
+                    'hosts': self.hosts,
+                    'groups': self.groups,
+                    'children': self.children,
+                    'created': self.created})
+
+
+    def resolve(self, host_pattern, with_groups=False):
+        """Returns a list of HostRecord objects matching the pattern, in the
+        same order as InventoryManager.get_hosts() would.  Handles names,
+        groups, wildcards, regexes (~), subscripts, intersections (&) and
+        exclusions (!) in the same way as Ansible.  Returns None if Ansible
+        is needed, i.e. if the pattern is malformed, a term matches nothing
+        (so that Ansible can warn about it or add an implicit localhost), or
+        the pattern might be an address rather than a list of terms."""
+
+        terms = split_pattern(host_pattern)
+        if terms is None:
+            return None
+
+        # Like Ansible, apply plain terms first, then intersections, then
+        # exclusions, starting with all hosts if there are no plain terms
+        regular = [term for term in terms if term[0] not in "&!"] or ['all']
+        intersections = [term for term in terms if term[0] == "&"]
+        exclusions = [term for term in terms if term[0] == "!"]
+
+        indexes = []
+        for term in regular + intersections + exclusions:
+            if term in self.host_indexes:
+                indexes.append(self.host_indexes[term])
+                continue
+            matches = self.match_term(term)
+            if matches is None:
+                return None
+            if term[0] == "!":
+                matches = set(matches)
+                indexes = [n for n in indexes if n not in matches]
+            elif term[0] == "&":
+                matches = set(matches)
+                indexes = [n for n in indexes if n in matches]
+            else:
+                indexes.extend(matches)
+
+        records = []
+        seen = set()
+        for n in indexes:
+            if n not in seen:
+                seen.add(n)
+                records.append(HostRecord(*self.hosts[n],
+                                          groups=self.groups_of(n) if with_groups else None))
+        return records
+
+
+    def match_term(self, term):
+        """Returns a list of the indexes of the hosts matching a single term
+        (ignoring any & or ! prefix), possibly with duplicates, or None if
+        Ansible is needed."""
+
+        if term[0] in "&!":
+            term = term[1:]
+        if not term:
+            return None
+
+        subscript = None
+        match = SUBSCRIPT_RE.match(term) if term[0] != '~' else None
+        if match:
+            term, index, start, separator, end = match.groups()
+            if index:
+                subscript = (int(index), None)
+            else:
+                subscript = (int(start), int(end) if end else -1)
+
+        if term[0] == '~':
+            try:
+                regex = re.compile(term[1:])
+            except re.error:
+                return None
+        else:
+            import fnmatch
+
+            regex = re.compile(fnmatch.translate(term))
+
+        matches = []
+        matching_groups = [name for name in self.groups if regex.match(name)]
+        for name in matching_groups:
+            matches.extend(self.groups[name])
+        if not matching_groups or term[0] == '~' or any(c in term for c in HOST_PATTERN_CHARS):
+            matches.extend(n for n, entry in enumerate(self.hosts) if regex.match(entry[0]))
+        if not matches and not matching_groups:
+            return None
+
+        if subscript:
+            start, end = subscript
+            try:
+                if end is None:
+                    matches = [matches[start]]
+                else:
+                    if end == -1:
+                        end = len(matches) - 1
+                    matches = matches[start:end + 1]
+            except IndexError:
+                # Ansible reports this as an error
+                return None
+        return matches
+
+
+    def groups_of(self, index):
+        """Returns the names of the groups that a host is in."""
+        if self.host_groups is None:
+            self.host_groups = {}
+            for name, members in self.groups.items():
+                if name not in IMPLICIT_GROUPS:
+                    for n in members:
+                        self.host_groups.setdefault(n, []).append(name)
+        return self.host_groups.get(index, [])
+
+
+
 # *** FUNCTIONS ***
-def collate(host_pattern, inventory_filename, logger):
-    """Create a multi-dimensional array grouping hosts by provider and region."""
+def split_pattern(host_pattern):
+    """Splits a host pattern into terms the way that Ansible does, or returns
+    None if Ansible would treat the whole pattern as a single address (e.g.
+    "host:22" or an IPv6 address) instead."""
+    if ',' in host_pattern:
+        terms = host_pattern.split(',')
+    else:
+        terms = PATTERN_TERM_RE.findall(host_pattern)
+        if len(terms) > 1:
+            if '::' in host_pattern or terms[-1].isdigit() or \
+               (len(terms) == 8 and all(re.match(r'^[0-9a-fA-F]{1,4}$', t) for t in terms)):
+                return None
+    return [term.strip() for term in terms if term.strip()]
+
+
+def descendants(name, children):
+    """Returns the names of a group's child groups, their children and so
+    on, given a map of group name to the names of its children."""
+    found = []
+    pending = list(children.get(name, []))
+    while pending:
+        child = pending.pop(0)
+        if child not in found and child != name:
+            found.append(child)
+            pending.extend(children.get(child, []))
+    return found
+
+
+def cache_name(inventory_filename):
+    return cache.make_name("inventory", os.path.abspath(inventory_filename))
+
+
+def inventory_signature(inventory_filename):
+    """Returns a list of [path, mtime, size] for the inventory and everything
+    in the group_vars and host_vars directories alongside it, which changes
+    whenever any of them do."""
+
+    inventory_path = os.path.abspath(inventory_filename)
+    if os.path.isdir(inventory_path):
+        paths = [inventory_path]
+    else:
+        inventory_dir = os.path.dirname(inventory_path)
+        paths = [inventory_path,
+                 os.path.join(inventory_dir, "group_vars"),
+                 os.path.join(inventory_dir, "host_vars")]
+
+    signature = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in [""] + sorted(filenames):
+                    entry_path = os.path.join(dirpath, name)
+                    st = os.stat(entry_path)
+                    signature.append([entry_path, st.st_mtime_ns, st.st_size])
+        elif os.path.exists(path):
+            st = os.stat(path)
+            signature.append([path, st.st_mtime_ns, st.st_size])
+    return signature
+
+
+def is_script(path):
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+
+def find_sources(inventory_paths):
+    """Returns a list of InventorySource objects for the given files and
+    directories.  Executable files are dynamic sources, including those in
+    directories (at any depth); the rest of a directory is a single static
+    source, so that its files can refer to each other's groups."""
+
+    sources = []
+    for path in inventory_paths:
+        if not os.path.exists(path):
+            raise InventoryFileMissing("Inventory file missing: " + path)
+        if os.path.isdir(path):
+            static_paths = []
+            scripts = []
+            scan_directory(path, static_paths, scripts)
+            if not scripts:
+                sources.append(InventorySource(path))
+            else:
+                if static_paths:
+                    sources.append(InventorySource(path, static_paths))
+                sources.extend(InventorySource(script, dynamic=True) for script in scripts)
+        else:
+            sources.append(InventorySource(path, dynamic=is_script(path)))
+    return sources
+
+
+def scan_directory(directory, static_paths, scripts):
+    """Adds the paths of the inventory files in a directory (and its
+    subdirectories) to the appropriate list, skipping the same things as
+    Ansible."""
+    for name in sorted(os.listdir(directory)):
+        if IGNORED_NAMES_RE.search(name):
+            continue
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            scan_directory(path, static_paths, scripts)
+        elif is_script(path):
+            scripts.append(path)
+        else:
+            static_paths.append(path)
+
+
+def load_sources(sources, script_ttl, logger):
+    """Returns an InventoryCache for each source, parsing those that aren't
+    cached (or whose cache is out of date) and saving the result.  If there
+    are several of those, they're parsed at once in separate processes."""
+
+    caches = [None] * len(sources)
+    stale = []      # (index, signature) for each source that needs parsing
+    for n, source in enumerate(sources):
+        signature = inventory_signature(source.path)
+        caches[n] = InventoryCache.load(source.path, signature,
+                                        script_ttl if source.dynamic else None)
+        if not caches[n]:
+            stale.append((n, signature))
+
+    if len(stale) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Import Ansible first so that the workers inherit it (at least when
+        # they're forked) instead of each importing it; parse() handles it
+        # being missing
+        try:
+            import ansible.parsing.dataloader
+            import ansible.inventory.manager
+        except ImportError:
+            pass
+
+        # Scripts spend most of their time waiting (e.g. for a cloud API), so
+        # there can be more of them at once than CPUs
+        logger.info("parsing %d inventory sources", len(stale))
+        with ProcessPoolExecutor(max_workers=min(len(stale), (os.cpu_count() or 1) + 4)) as executor:
+            results = list(executor.map(parse_source, [sources[n].paths for n, signature in stale]))
+    else:
+        results = [parse_source(sources[n].paths) for n, signature in stale]
+
+    for (n, signature), (hosts, groups, children) in zip(stale, results):
+        caches[n] = InventoryCache(sources[n].path, signature, hosts, groups, children)
+        caches[n].save()
+    return caches
+
+
+def parse_source(paths):
+    """Returns the hosts, groups and child groups of an inventory source, as
+    InventoryCache stores them.  Runs in a separate process when several
+    sources are parsed at once, hence the plain return value."""
+    parsed = InventoryCache.from_manager(None, None, parse(paths))
+    free_parsed_inventory()
+    return parsed.hosts, parsed.groups, parsed.children
+
+
+def free_parsed_inventory():
+    """Frees Ansible's objects once nothing refers to a parsed inventory any
+    more.  They refer to each other, so this is done now rather than
+    whenever the collector next runs."""
+    gc.collect()
+
+
+def parse(inventory_filename):
+    """Returns an Ansible InventoryManager for the given inventory (a path or
+    a list of them)."""
+
+    # If we can't seem to find the ansible package, fail with a specific exit code to
+    # let bin/shepherd know
+    try:
+        from ansible.parsing.dataloader import DataLoader
+    except ImportError as e:
+        logging.warning(str(e))
+        raise SystemExit(98)
+    ## from ansible.inventory.data import InventoryData
+    from ansible.inventory.manager import InventoryManager
+    import ansible.errors
 
-    if not os.path.exists(inventory_filename):
-        raise InventoryFileMissing("Inventory file missing: " + inventory_filename)
     try:
         ## i = ansible.inventory.Inventory(inventory_filename)
         loader = DataLoader()
-        i = InventoryManager(loader, inventory_filename)
+        return InventoryManager(loader, inventory_filename)
     except ansible.errors.AnsibleError as e:
         raise InventoryError(str(e))
 
-    hosts = i.get_hosts(host_pattern)
+
+def collate(host_pattern, inventory_paths, logger, use_cache=True, with_groups=False,
+            script_ttl=SCRIPT_TTL):
+    """Create a multi-dimensional array grouping hosts by provider, profile
+    (i.e. account) and region, i.e.
+    host_maps[provider][profile][region][instance ID] is a HostRecord.  The
+    profile comes from the host's cloud_profile variable, and is None for
+    hosts without one (meaning the profile given on the command line).  The
+    records only list the hosts' groups if with_groups is True.
+
+    inventory_paths is a list of inventory files, directories and scripts
+    (or just one), which are combined like Ansible does.
+
+    Unless use_cache is False, each source is cached separately, and only
+    parsed by Ansible if it has changed since the last run (or for a script,
+    if its output is more than script_ttl seconds old), or if the host
+    pattern is too complicated to be resolved using the cache.  The cache is
+    also kept in memory, so later calls in the same process only have to
+    check the signatures."""
+
+    if isinstance(inventory_paths, str):
+        inventory_paths = [inventory_paths]
+    sources = find_sources(inventory_paths)
+
+    hosts = None
+    if use_cache:
+        cached = InventoryCache.merge(load_sources(sources, script_ttl, logger))
+        hosts = cached.resolve(host_pattern, with_groups)
+        if hosts is None:
+            logger.info("host pattern '%s' needs Ansible to resolve it", host_pattern)
+
+    if hosts is None:
+        i = parse(inventory_paths)
+        hosts = [HostRecord.from_ansible(host, with_groups) for host in i.get_hosts(host_pattern)]
+        del i
+        free_parsed_inventory()
 
     if not hosts:
         raise NoHostsError
-    
+
     host_maps = {}
-    for host in hosts:
-        # Attempt to look up various cloud info in the Ansible host file
-        try:
-            ## provider=host.get_variables()
-            provider = host.vars['cloud_provider']
-            instance_id = host.vars['cloud_instance_id']
-            region = host.vars['cloud_region']
+    for position, host in enumerate(hosts):
+        # Check for the cloud info from the Ansible host file
+        if host.provider is None or host.region is None or host.instance_id is None:
+            logger.warning("host '%s' doesn't have necessary cloud info", host.name)
+            continue
 
-            if not provider in host_maps:
-                host_maps[provider] = {}
+        host.position = position
+        if not host.provider in host_maps:
+            host_maps[host.provider] = {}
 
-            if not region in host_maps[provider]:
-                host_maps[provider][region] = {}
+        if not host.profile in host_maps[host.provider]:
+            host_maps[host.provider][host.profile] = {}
 
-            host_maps[provider][region][instance_id] = host
-        except KeyError:
-            logger.warning("host '%s' doesn't have necessary cloud info", host.name)
+        if not host.region in host_maps[host.provider][host.profile]:
+            host_maps[host.provider][host.profile][host.region] = {}
+
+        host_maps[host.provider][host.profile][host.region][host.instance_id] = host
 
     return host_maps
@@ -0,0 +1,144 @@
+"""Polling engine that waits for cohorts to reach their desired state."""
+
+
+import heapq
+import random
+import sys
+import time
+
+
+# Delay (in seconds) before the first check of a cohort, per action.  Reboots
+# hardly change the instance state at all, whereas stopping and terminating
+# usually take a while.
+INITIAL_DELAYS = {'start':   2.0,
+                  'restart': 1.0,
+                  'stop':    5.0,
+                  'kill':    5.0}
+DEFAULT_INITIAL_DELAY = 2.0
+
+# After each check that finds deviants, the cohort's delay is multiplied by
+# this (up to the maximum interval), then randomised by up to +/- JITTER of
+# itself so that cohorts don't all hit the API at the same moment
+BACKOFF_FACTOR = 1.5
+JITTER = 0.2
+
+
+# *** CLASSES ***
+class Poller(object):
+    """Checks each cohort on its own schedule, backing off exponentially
+    while it still has deviants and retiring it as soon as it has none."""
+
+    def __init__(self, action, max_interval, timeout, verbose=1, output=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.initial_delay = min(INITIAL_DELAYS.get(action, DEFAULT_INITIAL_DELAY),
+                                 max_interval)
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.verbose = verbose
+        self.output = output
+        self.clock = clock
+        self.sleep = sleep
+        # Statistics about the last run
+        self.checks = 0
+
+
+    def jitter(self, delay):
+        return delay * random.uniform(1 - JITTER, 1 + JITTER)
+
+
+    def show_progress(self):
+        if self.verbose >= 2:
+            # Show a line of progress dots.  Don't use 'print' because it adds a space.
+            output = self.output or sys.stdout
+            output.write(".")
+            output.flush()
+
+
+    def run(self, cohorts):
+        """Polls the given cohorts until they have all converged or the
+        timeout has expired.  Returns the number of instances that still
+        don't match the desired state."""
+
+        start = self.clock()
+        deadline = start + self.timeout
+
+        # Entries are (due time, sequence number, delay, cohort, first run);
+        # the unique sequence number stops cohorts from ever being compared
+        schedule = []
+        for seq, cohort in enumerate(cohorts):
+            heapq.heappush(schedule,
+                           (start + self.jitter(self.initial_delay), seq,
+                            self.initial_delay, cohort, True))
+
+        deviants = {}
+        self.checks = 0
+        while schedule:
+            due, seq, delay, cohort, first_run = heapq.heappop(schedule)
+
+            # Always make one last check at the deadline
+            now = self.clock()
+            if due > deadline:
+                due = deadline
+            if due > now:
+                self.sleep(due - now)
+
+            deviants[seq] = cohort.num_deviants(first_run)
+            self.checks += 1
+            self.show_progress()
+
+            if deviants[seq] == 0:
+                # This cohort is retired
+                continue
+            if self.clock() >= deadline:
+                # Give up on this cohort
+                continue
+
+            delay = min(delay * BACKOFF_FACTOR, self.max_interval)
+            heapq.heappush(schedule,
+                           (self.clock() + self.jitter(delay), seq,
+                            delay, cohort, False))
+
+        return sum(deviants.values())
+
+
+    async def poll_async(self, cohort):
+        """Asynchronous counterpart of run() for a single cohort, so that it
+        can be polled as soon as its action has been taken, while other
+        cohorts are still busy.  The timeout starts now.  Returns the number
+        of instances that still don't match the desired state."""
+        import asyncio
+
+        start = self.clock()
+        deadline = start + self.timeout
+        delay = self.initial_delay
+        due = start + self.jitter(delay)
+        first_run = True
+        while True:
+            # Always make one last check at the deadline
+            now = self.clock()
+            if due > deadline:
+                due = deadline
+            if due > now:
+                await asyncio.sleep(due - now)
+
+            deviants = await cohort.async_num_deviants(first_run)
+            first_run = False
+            self.checks += 1
+            self.show_progress()
+
+            if deviants == 0:
+                return 0
+            if self.clock() >= deadline:
+                return deviants
+
+            delay = min(delay * BACKOFF_FACTOR, self.max_interval)
+            due = self.clock() + self.jitter(delay)
+
+
+
+# *** FUNCTIONS ***
+def timeout_for(params):
+    """Returns how long to poll for (in seconds), given the options."""
+    if params['timeout']:
+        return params['timeout']
+    return params['poll_interval'] * params['max_poll']
@@ -1,19 +1,31 @@
 
 
+from . import formatting
+
 
 # *** CLASSES ***
 class Cohort(object):
     """Handles operations for a group of hosts, for a specific provider."""
     # TO-DO: think about having the subclass look up the IDs
 
-    def __init__(self, region, ids, host_map, params):
+    def __init__(self, region, ids, host_map, params, profile=None):
         """@param host_map is the mapping, for all specified hosts in this
-        region, of instance ID to Ansible inventory object."""
+        region, of instance ID to inventory.HostRecord.
+        @param profile is the account profile (credentials) to use, or None
+        for the one given on the command line."""
         self.instance_ids = ids
         self.host_map = host_map
         self.global_params = params
         self.region = region
+        self.profile = profile
         self.logger = params['logger']
+        # Where to write messages for this cohort; None means sys.stdout
+        self.output = None
+        # Where to send records describing hosts
+        self.formatter = formatting.TableFormatter()
+        # Instance ID -> error message, for instances that the action couldn't
+        # be taken on (these have already been reported)
+        self.failures = {}
 
 
     def take_action(self, action):
@@ -24,3 +36,44 @@ class Cohort(object):
         """Used during polling.  Returns the number of instances in a given
         cohort that don't match the state indicated by the given action."""
         return 0
+
+
+    def action_required(self):
+        """Used after polling.  Returns whether any instance wasn't already
+        in the state indicated by the action when it was taken (True if
+        that isn't known)."""
+        return True
+
+
+    def current_states(self):
+        """Used by the watch action.  Returns a mapping of instance ID to a
+        short description of the instance's state, for every instance in the
+        cohort that still exists."""
+        raise NotImplementedError
+
+
+    def instance_status(self, id):
+        """Returns a short description of how far the action has got for the
+        given instance, or None if nothing is known.  Used to report on the
+        instances when a run is interrupted."""
+        if id in self.failures:
+            return "failed: " + self.failures[id]
+        return None
+
+
+    # Asynchronous counterparts of the above, used by the asyncio engine (see
+    # shepherd.engine).  By default they run the synchronous methods in the
+    # event loop's executor, so existing cohorts work unchanged; subclasses
+    # with native async support can override them.
+    async def async_take_action(self, action):
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.take_action, action)
+
+
+    async def async_num_deviants(self, first_run):
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.num_deviants, first_run)
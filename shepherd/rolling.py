@@ -0,0 +1,105 @@
+"""Rolling actions: taking the action on a region's instances a wave at a
+time, and waiting for each wave to reach the desired state before starting
+the next, so that only part of the fleet is ever out of service.  Regions
+still roll concurrently, as they're separate cohorts.  Restarts can't be
+done in waves, since an instance's state doesn't change while it reboots."""
+
+
+import math
+import time
+
+from . import provider
+from . import polling
+from .utils import messages
+
+
+# *** CLASSES ***
+class RollingCohort(provider.Cohort):
+    """Takes the action on the instances in waves, each of which is a cohort
+    of the provider's own class."""
+
+    def __init__(self, module, region, ids, host_map, params, profile=None):
+        """@param module is the provider's module."""
+        super(RollingCohort, self).__init__(region, ids, host_map, params, profile)
+        size = wave_size(len(ids), params)
+        self.waves = [ids[n:n + size] for n in range(0, len(ids), size)]
+        # Created up front, so that the region and credentials are checked
+        # before anything is done
+        self.wave_cohorts = [module.PerRegionCohort(region, ids, {id: host_map[id] for id in ids},
+                                                    params, profile)
+                             for ids in self.waves]
+        self.cohorts = []       # one per wave that has been started
+        self.unsettled = []     # cohorts that didn't reach the desired state
+
+
+    def take_action(self, action):
+        params = self.global_params
+
+        for n, (ids, cohort) in enumerate(zip(self.waves, self.wave_cohorts)):
+            if n and params['wave_pause']:
+                time.sleep(params['wave_pause'])
+            if params['verbose'] >= 1 and len(self.waves) > 1:
+                print("Wave %d of %d in region %s:\n  " % (n + 1, len(self.waves), self.region),
+                      ", ".join(ids), file=self.output)
+
+            cohort.output = self.output
+            cohort.formatter = self.formatter
+            self.cohorts.append(cohort)
+            cohort.take_action(action)
+            self.failures.update(cohort.failures)
+
+            if params['dry_run'] or not cohort.instance_ids:
+                continue
+            poller = polling.Poller(action, params['poll_interval'], polling.timeout_for(params),
+                                    params['verbose'], self.output)
+            if poller.run([cohort]):
+                # Don't take any more instances out of service
+                self.unsettled.append(cohort)
+                not_started = [id for wave in self.waves[n + 1:] for id in wave]
+                if not_started:
+                    messages.report_error("Wave %d in region %s didn't finish; not starting the other %d instances"
+                                          % (n + 1, self.region, len(not_started)))
+                    for id in not_started:
+                        self.failures[id] = "not started"
+                break
+
+        self.instance_ids = [id for id in self.instance_ids if id not in self.failures]
+
+
+    def num_deviants(self, first_run):
+        # Waves that finished have already been checked
+        return sum(cohort.num_deviants(False) for cohort in self.unsettled)
+
+
+    def action_required(self):
+        return any(cohort.action_required() for cohort in self.cohorts)
+
+
+    def instance_status(self, id):
+        status = super(RollingCohort, self).instance_status(id)
+        if status:
+            return status
+        for cohort in self.cohorts:
+            if id in cohort.host_map:
+                return cohort.instance_status(id)
+        return "not started"
+
+
+
+# *** FUNCTIONS ***
+def wave_size(count, params):
+    """Returns the number of instances (out of count) per wave."""
+    if params['wave_size']:
+        return params['wave_size']
+    if params['wave_percent']:
+        return max(1, int(math.ceil(count * params['wave_percent'] / 100.0)))
+    return max(count, 1)
+
+
+def make_cohort(module, action, region, ids, host_map, params, profile=None):
+    """Returns a cohort of the provider's class, or a RollingCohort if the
+    action changes the instances' state and waves were asked for."""
+    if (params['wave_size'] or params['wave_percent']) and \
+       action != 'status' and action != 'fullstatus':
+        return RollingCohort(module, region, ids, host_map, params, profile)
+    return module.PerRegionCohort(region, ids, host_map, params, profile)
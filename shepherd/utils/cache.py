@@ -0,0 +1,52 @@
+"""Simple on-disk cache of JSON documents, kept in ~/.cache/shepherd (or
+under $XDG_CACHE_HOME if that's set).  The cache is only ever an
+optimisation, so problems reading or writing it are silently ignored."""
+
+
+import os
+import json
+
+
+def cache_dir():
+    base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "shepherd")
+
+
+def make_name(prefix, *parts):
+    """Returns a cache entry name that's unique to the given strings."""
+    import hashlib
+
+    digest = hashlib.sha1("\0".join(parts).encode('utf-8')).hexdigest()
+    return "%s-%s.json" % (prefix, digest[:16])
+
+
+def load(name):
+    """Returns the document stored under the given name, or None if there
+    isn't one (or it can't be read)."""
+    try:
+        with open(os.path.join(cache_dir(), name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save(name, data):
+    """Stores the given document under the given name.  The file is replaced
+    atomically so concurrent readers never see a partial document."""
+    import tempfile
+
+    directory = cache_dir()
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix="." + name)
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(temp_path, os.path.join(directory, name))
+    except (OSError, TypeError, ValueError):
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
@@ -14,16 +14,15 @@ class CommandlineError(RuntimeError):
 class Controller(object):
     """Keeps track of the various cmdline options and handler objects."""
 
-    handlers = []
-    allowed_options = ''
-    allowed_long_options = []
-
-
     def __init__(self, throw=False):
         """@p throw: whether or not to raise an exception instead of exiting in
                      the case of a command line error."""
         self.throw = throw
-        pass
+        # Per instance, so that each command line processed gets a fresh set
+        # of handlers
+        self.handlers = []
+        self.allowed_options = ''
+        self.allowed_long_options = []
 
 
     def add_handler(self, handler):
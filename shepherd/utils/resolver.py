@@ -0,0 +1,153 @@
+"""Reverse DNS lookups that run concurrently in the background, each with a
+time limit, and whose results (including failures) are remembered for the
+rest of the run and optionally on disk (except for lookups that timed out)."""
+
+
+import queue
+import socket
+import threading
+import time
+
+from . import cache
+
+
+DEFAULT_TIMEOUT = 2.0
+NUM_WORKERS = 16
+# Workers that are stuck in lookups that timed out are replaced, but only up
+# to this many threads in total
+MAX_WORKERS = 2 * NUM_WORKERS
+CACHE_NAME = "ptr.json"
+
+
+# *** CLASSES ***
+class Lookup(object):
+    def __init__(self):
+        self.started = None     # time a worker picked it up
+        self.done = False
+        self.name = None        # None means no PTR record (or no answer in time)
+        # Whether the result is worth remembering across runs, i.e. it didn't
+        # time out or fail for some other reason
+        self.definite = False
+
+
+
+class ReverseResolver(object):
+    """socket.gethostbyaddr() can't be given a timeout, so lookups are done by
+    daemon worker threads and callers just stop waiting after the timeout."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, ttl=0):
+        """@param ttl is the number of seconds that results are kept in the
+        on-disk cache; 0 means don't use it."""
+        self.timeout = timeout
+        self.ttl = ttl
+        self.condition = threading.Condition()
+        self.lookups = {}
+        self.queue = queue.Queue()
+        self.num_workers = 0
+        self.num_stuck = 0      # workers still busy with lookups that timed out
+        self.dirty = False
+
+        if ttl:
+            now = time.time()
+            data = cache.load(CACHE_NAME) or {}
+            for address, (name, timestamp) in data.items():
+                if now - timestamp < ttl:
+                    lookup = Lookup()
+                    lookup.done = True
+                    lookup.definite = True
+                    lookup.name = name
+                    lookup.timestamp = timestamp
+                    self.lookups[address] = lookup
+
+
+    def start_worker(self):
+        worker = threading.Thread(target=self.work, name="resolver")
+        worker.daemon = True
+        worker.start()
+        self.num_workers += 1
+
+
+    def work(self):
+        while True:
+            address, lookup = self.queue.get()
+            with self.condition:
+                if lookup.done:
+                    # Given up on while it was still queued
+                    continue
+                lookup.started = time.monotonic()
+                self.condition.notify_all()
+            definite = True
+            try:
+                name = socket.gethostbyaddr(address)[0]
+            except (socket.herror, socket.gaierror):
+                name = None
+            except OSError:
+                name = None
+                definite = False
+            with self.condition:
+                if lookup.done:
+                    # It timed out, so this worker was counted as stuck
+                    self.num_stuck -= 1
+                else:
+                    lookup.name = name
+                    lookup.timestamp = time.time()
+                    lookup.done = True
+                    lookup.definite = definite
+                    self.dirty = self.dirty or definite
+                self.condition.notify_all()
+
+
+    def prefetch(self, addresses):
+        """Starts looking up any of the given addresses that haven't already
+        been looked up."""
+        with self.condition:
+            for address in addresses:
+                if address not in self.lookups:
+                    if self.num_workers < NUM_WORKERS:
+                        self.start_worker()
+                    self.lookups[address] = Lookup()
+                    self.queue.put((address, self.lookups[address]))
+
+
+    def lookup(self, address):
+        """Returns the name for the address, or None if there isn't one or it
+        took longer than the timeout to find out."""
+        self.prefetch([address])
+        with self.condition:
+            lookup = self.lookups[address]
+            while not lookup.done:
+                if lookup.started is None:
+                    if self.num_stuck == self.num_workers:
+                        # No worker will get to it until one of the stuck
+                        # ones does, and no more can be started
+                        lookup.done = True
+                    else:
+                        # Still queued; the timeout only starts once it's
+                        # running
+                        self.condition.wait()
+                else:
+                    remaining = lookup.started + self.timeout - time.monotonic()
+                    if remaining <= 0:
+                        lookup.done = True
+                        # The worker is stuck until the system resolver gives
+                        # up, so replace it (within limits)
+                        self.num_stuck += 1
+                        if self.num_workers < MAX_WORKERS:
+                            self.start_worker()
+                        self.condition.notify_all()
+                    else:
+                        self.condition.wait(remaining)
+            return lookup.name
+
+
+    def save(self):
+        """Writes finished lookups to the on-disk cache (if it's in use)."""
+        if not self.ttl:
+            return
+        with self.condition:
+            if not self.dirty:
+                return
+            data = {address: [lookup.name, lookup.timestamp]
+                    for address, lookup in self.lookups.items() if lookup.definite}
+            self.dirty = False
+        cache.save(CACHE_NAME, data)
@@ -0,0 +1,106 @@
+"""The last-seen records of instances (state plus the things shown by
+fullstatus), kept on disk so that repeated status queries can be answered
+without asking the provider."""
+
+
+import threading
+import time
+
+from . import cache
+
+
+CACHE_NAME = "states.json"
+
+# Entries older than this are dropped whenever the cache is saved, whatever
+# TTL other invocations might be using
+MAX_AGE = 86400
+
+
+# *** CLASSES ***
+class StateCache(object):
+    """Maps instance IDs to [time seen, record].  Changes are merged into the
+    on-disk copy by save(), so concurrent invocations don't lose each other's
+    entries (apart from the occasional race)."""
+
+    def __init__(self, ttl, fresh=False):
+        """@param ttl is how old (in seconds) a record can be and still be
+        used; 0 means never use the cache, only invalidate it.
+        @param fresh means don't use any records, but still store new ones."""
+        self.ttl = ttl
+        self.fresh = fresh
+        self.lock = threading.Lock()
+        self.entries = None
+        self.updated = {}
+        self.invalidated = set()
+
+
+    def get_fresh(self, ids):
+        """Returns a mapping of instance ID to record for those of the given
+        instances that have a fresh enough entry."""
+        records = {}
+        if not self.ttl or self.fresh:
+            return records
+
+        with self.lock:
+            if self.entries is None:
+                self.entries = cache.load(CACHE_NAME) or {}
+            now = time.time()
+            for id in ids:
+                entry = self.updated.get(id) or self.entries.get(id)
+                if entry and id not in self.invalidated and now - entry[0] < self.ttl:
+                    records[id] = entry[1]
+        return records
+
+
+    def update(self, records, keep_time=False):
+        """Stores the given (just fetched) records.  If keep_time is True,
+        the records came from the cache (e.g. with things added to them), so
+        they keep the time that they were originally seen, rather than being
+        made to look fresh."""
+        if not self.ttl:
+            return
+
+        now = time.time()
+        with self.lock:
+            for record in records:
+                seen = now
+                if keep_time:
+                    entry = self.updated.get(record['id']) or (self.entries or {}).get(record['id'])
+                    if entry:
+                        seen = entry[0]
+                self.updated[record['id']] = [seen, record]
+                self.invalidated.discard(record['id'])
+
+
+    def invalidate(self, ids):
+        """Forgets about the given instances, e.g. because they were just
+        started or stopped."""
+        with self.lock:
+            for id in ids:
+                self.updated.pop(id, None)
+                self.invalidated.add(id)
+
+
+    def save(self):
+        """Merges any changes into the on-disk cache."""
+        with self.lock:
+            if not self.updated and not self.invalidated:
+                return
+
+            # Re-read the cache to pick up changes made by other invocations
+            data = cache.load(CACHE_NAME)
+            if data is None:
+                if not self.updated:
+                    # Nothing to invalidate
+                    self.invalidated = set()
+                    return
+                data = {}
+
+            now = time.time()
+            data = {id: entry for id, entry in data.items()
+                    if id not in self.invalidated and now - entry[0] < MAX_AGE}
+            data.update(self.updated)
+            self.entries = data
+            self.updated = {}
+            self.invalidated = set()
+            cache.save(CACHE_NAME, data)
@@ -0,0 +1,112 @@
+"""The watch action: shows the state of every instance, then keeps checking
+them and shows just the instances whose state has changed, until interrupted
+(or until the --timeout has passed).  The cohorts and API clients are set up
+once, and each check is one (paginated) describe request per region, with
+every region checked at once."""
+
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import formatting
+from . import errors
+from .utils import messages
+
+
+# *** CLASSES ***
+class Watcher(object):
+    def __init__(self, host_maps, params, clock=time.monotonic, sleep=time.sleep):
+        self.host_maps = host_maps
+        self.params = params
+        self.clock = clock
+        self.sleep = sleep
+        self.cohorts = []
+        self.states = []        # for each cohort, instance ID -> last state seen
+        self.formatter = formatting.make_formatter(params['format'], 'watch', params.get('records'))
+
+
+    def setup(self):
+        for provider in self.host_maps:
+            try:
+                module = __import__(provider, globals=globals(), level=1)
+                module.init(self.params)
+            except ImportError as e:
+                raise errors.ProviderError("Unknown provider " + provider)
+
+            for profile in self.host_maps[provider]:
+                for region, host_map in self.host_maps[provider][profile].items():
+                    self.cohorts.append(module.PerRegionCohort(region, list(host_map), host_map,
+                                                               self.params, profile))
+                    self.states.append({})
+
+
+    def run(self):
+        """Checks every interval until interrupted or timed out."""
+        self.setup()
+        interval = self.params['poll_interval']
+        if self.params['timeout']:
+            deadline = self.clock() + self.params['timeout']
+        else:
+            deadline = None
+
+        if self.params['verbose'] >= 1:
+            messages.report_info("Watching %d instances every %d seconds; interrupt to stop" %
+                                 (sum(len(cohort.instance_ids) for cohort in self.cohorts), interval))
+
+        with ThreadPoolExecutor(max_workers=max(len(self.cohorts), 1)) as executor:
+            try:
+                next_check = self.clock()
+                while True:
+                    self.check(executor)
+                    next_check += interval
+                    if deadline is not None and next_check > deadline:
+                        break
+                    now = self.clock()
+                    if next_check > now:
+                        self.sleep(next_check - now)
+                    else:
+                        # Checks are taking longer than the interval, so
+                        # don't try to catch up
+                        next_check = now
+            except KeyboardInterrupt:
+                pass
+
+        self.formatter.end()
+
+
+    def check(self, executor):
+        """Refreshes the states of every cohort at once, then shows the
+        instances whose state differs from last time."""
+        results = list(executor.map(self.fetch, self.cohorts))
+        timestamp = time.strftime("%H:%M:%S")
+
+        for cohort, previous, states in zip(self.cohorts, self.states, results):
+            if states is None:
+                continue
+            for id in cohort.instance_ids:
+                state = states.get(id, "missing")
+                if previous.get(id) != state:
+                    self.formatter.write({'name': cohort.host_map[id].name,
+                                          'id': id,
+                                          'state': state,
+                                          'provider': cohort.host_map[id].provider,
+                                          'region': cohort.region,
+                                          'previous_state': previous.get(id),
+                                          'time': timestamp})
+                    previous[id] = state
+
+
+    def fetch(self, cohort):
+        # A region that can't be reached, or that rejects the request, is
+        # just skipped this time
+        try:
+            return cohort.current_states()
+        except (errors.NetworkError, errors.RequestError) as e:
+            messages.report_warning("Can't check region %s: %s" % (cohort.region, e))
+            return None
+
+
+
+# *** FUNCTIONS ***
+def run(host_maps, params):
+    Watcher(host_maps, params).run()
@@ -0,0 +1,161 @@
+#! /usr/bin/env python3
+# tests/check-chunk-bisection.py (Python script) -- fails if bad instances stop the action being taken on the rest
+#
+# Runs aws.PerRegionCohort.act() against a fake EC2 client that rejects any
+# request containing certain instances, and checks that the chunks holding
+# them are bisected until they're isolated, so that the action is still
+# taken (exactly once) on every other instance.  Also checks that throttled
+# chunks aren't bisected, and that errors about the request as a whole are
+# raised.  Needs botocore to be installed, but nothing is sent to AWS.
+#
+# Usage: tests/check-chunk-bisection.py [ -v ]
+
+
+
+import contextlib
+import io
+import logging
+import os
+import sys
+import threading
+
+
+NUM_INSTANCES = 20
+CHUNK_SIZE = 8
+
+failures = []
+verbose = False
+
+
+class FakeClient(object):
+    """Answers stop_instances() for instances that are running or stopped,
+    rejecting the whole request if it includes any of the instances in bad
+    (with error_code)."""
+
+    def __init__(self, states, bad=(), error_code="IncorrectInstanceState"):
+        self.states = states
+        self.bad = set(bad)
+        self.error_code = error_code
+        self.lock = threading.Lock()
+        self.requests = []      # (instance IDs, whether it succeeded)
+
+
+    def stop_instances(self, InstanceIds, DryRun):
+        import botocore.exceptions
+
+        ok = not self.bad.intersection(InstanceIds)
+        with self.lock:
+            self.requests.append((tuple(InstanceIds), ok))
+        if not ok:
+            raise botocore.exceptions.ClientError({'Error': {'Code': self.error_code,
+                                                             'Message': "rejected"}},
+                                                  'StopInstances')
+        return {'StoppingInstances': [{'InstanceId': id,
+                                       'PreviousState': {'Code': self.states[id]},
+                                       'CurrentState': {'Code': 64, 'Name': "stopping"}}
+                                      for id in InstanceIds]}
+
+
+
+def check(description, ok, detail=""):
+    if not ok:
+        failures.append(description)
+        print("FAIL: %s%s" % (description, detail and ": " + detail))
+    elif verbose:
+        print("ok: %s" % description)
+
+
+def make_cohort(client):
+    """Returns a cohort for NUM_INSTANCES instances that uses client, without
+    the region and credentials checks that a real one makes."""
+    import botocore.exceptions
+    from shepherd import aws
+    from shepherd import inventory
+    from shepherd import provider
+
+    # Normally loaded by aws.init()
+    aws.botocore = botocore
+
+    ids = ["i-%02d" % n for n in range(NUM_INSTANCES)]
+    host_map = {id: inventory.HostRecord("host" + id[1:], 'aws', 'us-east-1', id) for id in ids}
+    params = {'logger': logging.getLogger("shepherd"), 'chunk_size': CHUNK_SIZE,
+              'dry_run': False, 'verbose': 0}
+    cohort = aws.PerRegionCohort.__new__(aws.PerRegionCohort)
+    provider.Cohort.__init__(cohort, 'us-east-1', ids, host_map, params, 'default')
+    cohort.desired_state = aws.ACTION_STATE_MAP['stop']
+    cohort.client = client
+    return cohort
+
+
+def act(cohort):
+    """Takes the action, returning the exception raised (if any)."""
+    try:
+        with contextlib.redirect_stderr(io.StringIO()):
+            cohort.act('stop')
+    except Exception as e:
+        return e
+    return None
+
+
+def main():
+    global verbose
+    verbose = sys.argv[1:] == ['-v']
+    top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, top_dir)
+
+    ids = ["i-%02d" % n for n in range(NUM_INSTANCES)]
+    bad = ["i-03", "i-17"]
+    good = [id for id in ids if id not in bad]
+
+    client = FakeClient({id: 16 for id in ids}, bad)
+    cohort = make_cohort(client)
+    error = act(cohort)
+    check("instance errors aren't raised", error is None, repr(error))
+    check("the bad instances are the ones that failed", sorted(cohort.failures) == bad,
+          repr(sorted(cohort.failures)))
+    check("the bad instances are dropped from the cohort", cohort.instance_ids == good,
+          repr(cohort.instance_ids))
+    acted_on = sorted(id for request, ok in client.requests if ok for id in request)
+    check("the action is taken exactly once on every other instance", acted_on == good,
+          repr(acted_on))
+    check("each bad instance ends up in a request by itself",
+          all(((id,), False) in client.requests for id in bad))
+    check("the chunk without bad instances is sent once",
+          sum(1 for request, ok in client.requests if "i-08" in request) == 1)
+    check("bisection takes fewer requests than one per instance",
+          len(client.requests) < NUM_INSTANCES, "%d requests" % len(client.requests))
+    check("outcomes are recorded for every instance",
+          all(cohort.outcomes.get(id) == (True, "stopping") for id in good) and
+          all(not cohort.outcomes.get(id, (True,))[0] for id in bad))
+    check("instances that weren't in the desired state needed the action",
+          cohort.action_required())
+
+    client = FakeClient({id: 80 for id in ids})
+    cohort = make_cohort(client)
+    act(cohort)
+    check("instances that were already in the desired state didn't need the action",
+          not cohort.action_required())
+
+    client = FakeClient({id: 16 for id in ids}, ["i-10"], "RequestLimitExceeded")
+    cohort = make_cohort(client)
+    error = act(cohort)
+    throttled = ["i-%02d" % n for n in range(CHUNK_SIZE, 2 * CHUNK_SIZE)]
+    check("a throttled chunk fails as a whole, without being bisected",
+          error is None and sorted(cohort.failures) == throttled and
+          sum(1 for request, ok in client.requests if not ok) == 1,
+          repr(sorted(cohort.failures)))
+
+    client = FakeClient({id: 16 for id in ids}, ["i-10"], "AuthFailure")
+    cohort = make_cohort(client)
+    error = act(cohort)
+    check("other errors are raised", error is not None and
+          error.response['Error']['Code'] == "AuthFailure", repr(error))
+
+    if failures:
+        return 1
+    print("OK: bad instances were isolated in chunks of %d" % CHUNK_SIZE)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+#! /usr/bin/env python3
+# tests/check-host-patterns.py (Python script) -- fails if the inventory cache resolves host patterns differently from Ansible
+#
+# Writes a small inventory (one source, then the same hosts split across two
+# sources), and checks that InventoryCache.resolve() returns the same hosts
+# in the same order as Ansible's InventoryManager.get_hosts() for every
+# pattern in PATTERNS.  Also checks which patterns are resolved from the
+# cache at all, rather than being handed to Ansible, so that changes in
+# either direction are noticed.  Needs Ansible to be installed.
+#
+# Usage: tests/check-host-patterns.py [ -v ]
+
+
+
+import os
+import sys
+import tempfile
+
+
+MAIN_INVENTORY = """\
+lonely.example.com
+10.0.0.9
+
+[web]
+web1.example.com
+web2.example.com
+web3.example.com
+
+[db]
+db1.example.com
+db2.example.com
+
+[app]
+web2.example.com
+app1.example.com
+
+[prod:children]
+web
+db
+
+[dev]
+dev1.example.com
+web3.example.com
+"""
+
+# The same hosts and groups, split into two sources (the second refers to
+# groups in the first)
+SPLIT_INVENTORIES = ("""\
+lonely.example.com
+
+[web]
+web1.example.com
+web2.example.com
+
+[db]
+db1.example.com
+db2.example.com
+
+[app]
+web2.example.com
+app1.example.com
+""", """\
+10.0.0.9
+
+[web]
+web3.example.com
+
+[db]
+
+[prod:children]
+web
+db
+
+[dev]
+dev1.example.com
+web3.example.com
+""")
+
+# Each pattern, and whether it should be resolved from the cache (False
+# means that it's meant to be handed to Ansible)
+PATTERNS = [('all', True),
+            ('*', True),
+            ('web', True),
+            ('web:db', True),
+            ('web,db', True),
+            ('db:web', True),
+            ('web:app', True),
+            ('web:&app', True),
+            ('&app:web', True),
+            ('prod', True),
+            ('prod:!db', True),
+            ('prod:&dev', True),
+            ('prod:!web2.example.com', True),
+            ('!db', True),
+            ('all:!prod', True),
+            ('all:!ungrouped', True),
+            ('ungrouped', True),
+            ('web[0]', True),
+            ('web[1]', True),
+            ('web[-1]', True),
+            ('web[0:1]', True),
+            ('web[1:]', True),
+            ('web[0-1]', True),
+            ('prod[3]', True),
+            ('db[0]:web[2]', True),
+            ('web[7]', False),
+            ('~web[12]', True),
+            ('~^db', True),
+            ('~(web|db)1', True),
+            ('w*', True),
+            ('*.example.com', True),
+            ('web?.example.com', True),
+            ('web*:!web1*', True),
+            ('web1.example.com', True),
+            ('web1.example.com:db2.example.com', True),
+            ('lonely.example.com', True),
+            ('10.0.0.9', True),
+            ('10.0.0.*', True),
+            ('nonexistent', False),
+            ('web:nonexistent', False),
+            ('localhost', False),
+            ('web1.example.com:22', False),
+            ('fe80::1', False),
+            ('', True)]
+
+
+def ansible_hosts(paths, pattern):
+    """Returns the names of the hosts that Ansible matches, or None if it
+    rejects the pattern."""
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.inventory.manager import InventoryManager
+    import ansible.errors
+
+    manager = InventoryManager(DataLoader(), paths)
+    try:
+        return [host.name for host in manager.get_hosts(pattern)]
+    except ansible.errors.AnsibleError:
+        return None
+
+
+def check(description, paths, verbose):
+    """Returns the number of patterns that the cache got wrong."""
+    from shepherd import inventory
+
+    caches = [inventory.InventoryCache.from_manager(path, None, inventory.parse(path))
+              for path in paths]
+    cached = inventory.InventoryCache.merge(caches)
+
+    failures = 0
+    for pattern, should_resolve in PATTERNS:
+        expected = ansible_hosts(paths, pattern)
+        records = cached.resolve(pattern)
+        if records is None:
+            ok = not should_resolve
+            result = "(left to Ansible)"
+        else:
+            names = [record.name for record in records]
+            ok = should_resolve and names == expected
+            result = " ".join(names)
+        if not ok:
+            failures += 1
+            print("FAIL: %s: %r: cache gave %s, Ansible gave %s" %
+                  (description, pattern, result,
+                   "(error)" if expected is None else " ".join(expected)))
+        elif verbose:
+            print("ok: %s: %r: %s" % (description, pattern, result))
+    return failures
+
+
+def main():
+    verbose = sys.argv[1:] == ['-v']
+    top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, top_dir)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        main_path = os.path.join(work_dir, "hosts")
+        with open(main_path, 'w') as f:
+            f.write(MAIN_INVENTORY)
+        split_paths = []
+        for n, text in enumerate(SPLIT_INVENTORIES):
+            split_paths.append(os.path.join(work_dir, "hosts-%d" % n))
+            with open(split_paths[-1], 'w') as f:
+                f.write(text)
+
+        failures = check("one source", [main_path], verbose)
+        failures += check("two sources", split_paths, verbose)
+
+    if failures:
+        return 1
+    print("OK: %d host patterns resolved the same as Ansible" % len(PATTERNS))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+#! /usr/bin/env python3
+# tests/check-import-time.py (Python script) -- fails if "shepherd --help" imports too much
+#
+# Runs "shepherd --help" in a fresh interpreter under "python -X importtime"
+# and adds up the cumulative time of every top-level import.  Exits with 1 if
+# that exceeds the threshold (default 100 ms, or the first argument), or if any
+# of the slow-loading packages that are meant to be deferred got imported.
+#
+# Usage: tests/check-import-time.py [ <threshold-ms> ]
+
+
+
+import os
+import re
+import subprocess
+import sys
+
+
+# Packages that must only be loaded once an action actually needs them
+DEFERRED_PACKAGES = ('ansible', 'boto3', 'botocore')
+
+DEFAULT_THRESHOLD_MS = 100
+RUNS = 3
+
+program = 'import sys; sys.argv[1:] = ["--help"]; import shepherd; sys.exit(shepherd.main())'
+line_re = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def measure():
+    """Returns (total milliseconds, set of imported module names)."""
+    top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=top_dir)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', program],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            env=env, universal_newlines=True, check=True)
+    total_us = 0
+    modules = set()
+    for line in result.stderr.splitlines():
+        match = line_re.match(line)
+        if match:
+            modules.add(match.group(4))
+            # Nesting is shown by indentation; only count top-level imports
+            # because their cumulative time includes everything below them
+            if len(match.group(3)) == 1:
+                total_us += int(match.group(2))
+    return total_us / 1000.0, modules
+
+
+def main():
+    threshold = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_THRESHOLD_MS
+
+    # Take the best of a few runs to smooth out noise
+    timings = []
+    for n in range(RUNS):
+        total, modules = measure()
+        timings.append(total)
+    best = min(timings)
+
+    status = 0
+    deferred = sorted(m for m in modules if m.split('.')[0] in DEFERRED_PACKAGES)
+    if deferred:
+        print("FAIL: imported at startup: " + ", ".join(deferred[:10]))
+        status = 1
+
+    if best > threshold:
+        print("FAIL: startup imports took %.1f ms (threshold %.1f ms)" % (best, threshold))
+        status = 1
+    else:
+        print("OK: startup imports took %.1f ms (threshold %.1f ms)" % (best, threshold))
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+#! /usr/bin/env python3
+# tests/check-merging.py (Python script) -- fails if sorted output from several regions comes out wrong
+#
+# Feeds records for several regions into a formatting.MergingFormatter, one
+# region at a time and in a scrambled order, and checks that they come out
+# sorted, that each record is written as soon as no unfinished region could
+# still produce one before it, and that flush() writes what's been collected
+# from regions that never finished.
+#
+# Usage: tests/check-merging.py [ -v ]
+
+
+
+import os
+import sys
+
+
+# Host names for each region, in the order that their records are written
+REGIONS = {'us-east-1': ['host-d', 'host-b', 'host-f'],
+           'eu-west-1': ['host-c', 'host-a'],
+           'ap-south-1': ['host-g', 'host-e']}
+
+failures = []
+verbose = False
+
+
+def check(description, ok, detail=""):
+    if not ok:
+        failures.append(description)
+        print("FAIL: %s%s" % (description, detail and ": " + detail))
+    elif verbose:
+        print("ok: %s" % description)
+
+
+def make_sources(sort):
+    """Returns the list that records are written to, the merger and a source
+    for each region."""
+    from shepherd import formatting
+    from shepherd import inventory
+
+    written = []
+    merger = formatting.MergingFormatter(formatting.make_formatter('records', 'status', written),
+                                         sort)
+    sources = {}
+    for region, names in sorted(REGIONS.items()):
+        host_map = {"i-" + name: inventory.HostRecord(name, 'aws', region, "i-" + name)
+                    for name in names}
+        sources[region] = merger.add_source(host_map)
+    return written, merger, sources
+
+
+def write_region(sources, region):
+    for name in REGIONS[region]:
+        sources[region].write({'name': name, 'id': "i-" + name, 'state': "running",
+                               'provider': 'aws', 'region': region})
+
+
+def names(written):
+    return [record['name'] for record in written]
+
+
+def main():
+    global verbose
+    verbose = sys.argv[1:] == ['-v']
+    top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, top_dir)
+
+    written, merger, sources = make_sources('name')
+    for region in REGIONS:
+        write_region(sources, region)
+    check("nothing is written before a region ends", names(written) == [], repr(names(written)))
+    sources['eu-west-1'].end()
+    check("records that can't be beaten are written as soon as their region ends",
+          names(written) == ['host-a'], repr(names(written)))
+    sources['us-east-1'].end()
+    check("records are held back while an unfinished region could still beat them",
+          names(written) == ['host-a', 'host-b', 'host-c', 'host-d'], repr(names(written)))
+    sources['ap-south-1'].end()
+    merger.end()
+    check("every record is written in order once all regions end",
+          names(written) == sorted(name for region in REGIONS for name in REGIONS[region]),
+          repr(names(written)))
+
+    written, merger, sources = make_sources('name')
+    write_region(sources, 'us-east-1')
+    write_region(sources, 'ap-south-1')
+    sources['ap-south-1'].end()
+    merger.flush()
+    check("flush() writes the records of regions that didn't end",
+          names(written) == ['host-b', 'host-d', 'host-e', 'host-f', 'host-g'],
+          repr(names(written)))
+
+    written, merger, sources = make_sources('state')
+    for region in REGIONS:
+        write_region(sources, region)
+    sources['eu-west-1'].end()
+    sources['us-east-1'].end()
+    check("with a key that isn't known in advance, records wait for every region",
+          names(written) == [], repr(names(written)))
+    sources['ap-south-1'].end()
+    check("with a key that isn't known in advance, ties are broken by name",
+          names(written) == sorted(name for region in REGIONS for name in REGIONS[region]),
+          repr(names(written)))
+
+    if failures:
+        return 1
+    print("OK: records from %d regions were merged in order" % len(REGIONS))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+#! /usr/bin/env python3
+# tests/check-timing.py (Python script) -- fails if rate limiting, polling or watching keep the wrong time
+#
+# Drives aws.ratelimit.TokenBucket, polling.Poller and watch.Watcher with a
+# fake clock (whose sleep() just moves it on), using stand-in cohorts, and
+# checks when each of them waits and for how long.  Nothing is sent to AWS,
+# and no time actually passes.
+#
+# Usage: tests/check-timing.py [ -v ]
+
+
+
+import contextlib
+import io
+import os
+import random
+import sys
+
+
+failures = []
+verbose = False
+
+
+class FakeClock(object):
+    """Stands in for both time.monotonic() and time.sleep()."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+
+    def __call__(self):
+        return self.now
+
+
+    def sleep(self, seconds):
+        if seconds < 0:
+            raise ValueError("sleep length must be non-negative")
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+
+class PollCohort(object):
+    """Gives each of the given numbers of deviants in turn (repeating the
+    last one), and remembers when it was checked."""
+
+    def __init__(self, deviants):
+        self.deviants = deviants
+        self.checks = []        # (time, first_run)
+
+
+    def num_deviants(self, first_run):
+        self.checks.append((clock.now, first_run))
+        return self.deviants[min(len(self.checks), len(self.deviants)) - 1]
+
+
+
+class WatchCohort(object):
+    """Gives the states in timeline (a list of (time, ID -> state), in time
+    order) that apply at each check.  A check at one of the times in slow
+    takes slow[time] seconds, and one at a time in unreachable fails."""
+
+    def __init__(self, region, timeline, slow=None, unreachable=()):
+        from shepherd import inventory
+
+        self.region = region
+        self.timeline = timeline
+        self.slow = slow or {}
+        self.unreachable = unreachable
+        self.instance_ids = sorted(timeline[0][1])
+        self.host_map = {id: inventory.HostRecord("host-" + id, 'aws', region, id)
+                         for id in self.instance_ids}
+        self.checks = []
+
+
+    def current_states(self):
+        from shepherd import errors
+
+        now = clock.now
+        self.checks.append(now)
+        clock.now += self.slow.get(now, 0)
+        if now in self.unreachable:
+            raise errors.NetworkError("timeout or connection error")
+        return [states for start, states in self.timeline if start <= now][-1]
+
+
+
+clock = None
+
+
+def check(description, ok, detail=""):
+    if not ok:
+        failures.append(description)
+        print("FAIL: %s%s" % (description, detail and ": " + detail))
+    elif verbose:
+        print("ok: %s" % description)
+
+
+def close(a, b):
+    return abs(a - b) < 1e-6
+
+
+def check_token_bucket():
+    global clock
+    from shepherd.aws import ratelimit
+
+    clock = FakeClock()
+    bucket = ratelimit.TokenBucket(10.0, 5, clock, clock.sleep)
+
+    waits = [bucket.acquire() for n in range(5)]
+    check("token bucket: a full bucket doesn't wait", waits == [0.0] * 5 and clock.now == 0.0,
+          repr(waits))
+    wait = bucket.acquire()
+    check("token bucket: an empty bucket waits for the next token", close(wait, 0.1),
+          "waited %r" % wait)
+    for n in range(20):
+        bucket.acquire()
+    check("token bucket: an empty bucket hands out tokens at the rate", close(clock.now, 2.1),
+          "21 tokens took %r s" % clock.now)
+
+    bucket.throttled()
+    wait = bucket.acquire()
+    check("token bucket: throttling halves the rate", close(wait, 0.2), "waited %r" % wait)
+    for n in range(20):
+        bucket.throttled()
+    check("token bucket: throttling doesn't go below the minimum rate",
+          close(bucket.rate, 10.0 * ratelimit.MIN_RATE_FRACTION), "rate %r" % bucket.rate)
+
+    clock.now += 1 / ratelimit.RECOVERY_PER_SECOND
+    waits = [bucket.acquire() for n in range(5)]
+    check("token bucket: the rate and tokens recover over time",
+          close(bucket.rate, 10.0) and waits == [0.0] * 5, "rate %r, waits %r" % (bucket.rate, waits))
+
+    bucket.set_rate(2.0, 1)
+    clock.now += 10
+    waits = [bucket.acquire() for n in range(2)]
+    check("token bucket: a lower rate applies straight away", waits == [0.0, 0.5], repr(waits))
+
+    limiter = ratelimit.RateLimiter({'describe': 20.0, 'mutate': 0}, clock, clock.sleep)
+    describe = limiter.bucket('prod', 'us-east-1', 'DescribeInstances')
+    check("rate limiter: buckets are per profile and region",
+          describe is limiter.bucket('prod', 'us-east-1', 'DescribeVpcs') and
+          describe is not limiter.bucket(None, 'us-east-1', 'DescribeInstances') and
+          describe is not limiter.bucket('prod', 'eu-west-1', 'DescribeInstances'))
+    check("rate limiter: a rate of 0 means unlimited",
+          limiter.bucket('prod', 'us-east-1', 'StopInstances') is None)
+
+
+def check_poller():
+    global clock
+    from shepherd import polling
+
+    clock = FakeClock()
+    random.seed(1)
+    settling = PollCohort([3, 1, 0])
+    stuck = PollCohort([2])
+    done = PollCohort([0])
+    poller = polling.Poller('stop', 10, 60, verbose=0, clock=clock, sleep=clock.sleep)
+    remaining = poller.run([settling, stuck, done])
+
+    check("poller: returns the deviants left at the deadline", remaining == 2, repr(remaining))
+    check("poller: cohorts are retired once they converge",
+          len(settling.checks) == 3 and len(done.checks) == 1,
+          "%d and %d checks" % (len(settling.checks), len(done.checks)))
+    check("poller: only the first check of each cohort is a first run",
+          [first for t, first in settling.checks] == [True, False, False] and
+          not any(first for t, first in stuck.checks[1:]))
+    initial = polling.INITIAL_DELAYS['stop']
+    first_times = [cohort.checks[0][0] for cohort in (settling, stuck, done)]
+    check("poller: the first check is after the initial delay (with jitter)",
+          all(initial * (1 - polling.JITTER) - 1e-6 <= t <= initial * (1 + polling.JITTER) + 1e-6
+              for t in first_times), repr(first_times))
+    times = [t for t, first in stuck.checks]
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    check("poller: checks back off, up to the maximum interval",
+          gaps[0] > initial * (1 - polling.JITTER) and
+          max(gaps) <= 10 * (1 + polling.JITTER) + 1e-6 and
+          gaps[-2] > gaps[0], repr(gaps))
+    check("poller: there's always a last check at the deadline, and no later",
+          close(times[-1], 60) and close(clock.now, 60), "last check at %r" % times[-1])
+
+    clock = FakeClock()
+    poller = polling.Poller('start', 10, 60, verbose=0, clock=clock, sleep=clock.sleep)
+    remaining = poller.run([PollCohort([0]), PollCohort([0])])
+    check("poller: stops as soon as every cohort has converged",
+          remaining == 0 and clock.now <= polling.INITIAL_DELAYS['start'] * (1 + polling.JITTER),
+          "%r left after %r s" % (remaining, clock.now))
+
+
+def check_watcher():
+    global clock
+    from shepherd import formatting
+    from shepherd import watch
+
+    class FakeWatcher(watch.Watcher):
+        def setup(self):
+            pass
+
+    def make_watcher(cohorts, records):
+        params = {'poll_interval': 10, 'timeout': 35, 'verbose': 0,
+                  'format': 'records', 'records': records}
+        watcher = FakeWatcher({}, params, clock, clock.sleep)
+        watcher.cohorts = cohorts
+        watcher.states = [{} for cohort in cohorts]
+        return watcher
+
+    clock = FakeClock()
+    changing = WatchCohort('us-east-1', [(0, {'i-1': 'running', 'i-2': 'running'}),
+                                         (20, {'i-1': 'stopping', 'i-2': 'running'})])
+    flaky = WatchCohort('eu-west-1', [(0, {'i-3': 'stopped'}),
+                                      (10, {})],
+                        unreachable=(10,))
+    records = []
+    with contextlib.redirect_stderr(io.StringIO()):
+        make_watcher([changing, flaky], records).run()
+
+    check("watcher: checks every interval until the timeout",
+          changing.checks == [0, 10, 20, 30], repr(changing.checks))
+    changes = [(record['id'], record['previous_state'], record['state']) for record in records]
+    check("watcher: shows every instance, then only the ones that change",
+          changes == [('i-1', None, 'running'), ('i-2', None, 'running'),
+                      ('i-3', None, 'stopped'), ('i-1', 'running', 'stopping'),
+                      ('i-3', 'stopped', 'missing')],
+          repr(changes))
+
+    clock = FakeClock()
+    slow = WatchCohort('us-east-1', [(0, {'i-1': 'running'})], slow={10: 15})
+    make_watcher([slow], []).run()
+    check("watcher: a slow check delays the schedule rather than being caught up on",
+          slow.checks == [0, 10, 25, 35], repr(slow.checks))
+
+
+def main():
+    global verbose
+    verbose = sys.argv[1:] == ['-v']
+    top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, top_dir)
+
+    check_token_bucket()
+    check_poller()
+    check_watcher()
+
+    if failures:
+        return 1
+    print("OK: rate limiting, polling and watching kept the right time")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())